@@ -0,0 +1,403 @@
+# Headless rendering of a project's expression items, without REAPER (e.g. to pre-render on a build machine overnight,
+# or to measure render throughput without the DAW in the loop).
+# Usage: python batch_render.py project.RPP [--workers N] [--output rendered.RPP] [--profile profile.json]
+# The project's items are read from the .RPP file, and its lambdaw/project.py is loaded into a pool of worker processes
+# (see worker.py), which render every expression in dependency order (see deps.py), independent ones in parallel.
+# Audio goes into lambdaw/audio/ as it would inside REAPER, and a copy of the project is written with each expression take
+# pointing at its new render (or, for MIDI, holding its notes), so opening it in REAPER picks up the results.
+# Audio renders are added to lambdaw's render cache and project index, so they survive lambdaw's garbage collection
+# (e.g. when the original project, which shares the audio directory, is opened), and lambdaw adopts them when the copy is
+# loaded (see `lambdaw.validate_index`).
+#
+# Inputs are read from the files and MIDI chunks that the .RPP refers to, so only what lambdaw could read without REAPER's
+# help is supported: audio takes that play a WAV file at the project's sample rate as it is (as in `lambdaw.map_source`),
+# and MIDI takes with their events in the project. Tempo changes are ignored.
+import argparse
+import os
+import select
+import sys
+import time
+
+from notearray import NoteArray
+import cache
+import deps
+import notearray
+import profiling
+import render
+import worker
+
+MIDI_TICKS = 960  # per quarter note, REAPER's default for new MIDI items
+
+def split_line(line):
+    # Fields of a line of an .RPP file. Fields with spaces are quoted with whichever of ", ' or ` they don't contain.
+    fields = []
+    line = line.strip()
+    i = 0
+    while i < len(line):
+        if line[i] == " ":
+            i += 1
+        elif line[i] in "\"'`":
+            end = line.find(line[i], i + 1)
+            end = len(line) if end < 0 else end
+            fields.append(line[i + 1:end])
+            i = end + 1
+        else:
+            end = line.find(" ", i)
+            end = len(line) if end < 0 else end
+            fields.append(line[i:end])
+            i = end
+    return fields
+
+def quote(field):
+    for mark in "\"'`":
+        if mark not in field:
+            return mark + field + mark
+    raise ValueError(f"can't quote {field!r}")
+
+class Take:
+    # A take as read from an .RPP file: the take's own lines (NAME, SOFFS, PLAYRATE, ...), its source, and its item's position.
+    def __init__(self, position, length):
+        self.position = position
+        self.length = length
+        self.fields = {}  # first field of each line -> the rest
+        self.selected = False
+        self.has_fx = False
+        self.has_envelopes = False
+        self.source_type = None
+        self.file = None
+        self.source = None  # (first line, line after the end) of the source chunk in the .RPP
+
+    @property
+    def name(self):
+        return (self.fields.get("NAME") or [""])[0]
+
+    def number(self, field, index, default):
+        values = self.fields.get(field, ())
+        return float(values[index]) if len(values) > index else default
+
+class RppProject:
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.directory = os.path.dirname(self.path)
+        with open(self.path, encoding="utf8", errors="surrogateescape") as f:
+            self.lines = f.read().split("\n")
+        self.bpm, self.bpi = 120, 4
+        self.sample_rate = render.SAMPLE_RATE
+        self.ext_state = {}  # (section, key) -> value, lowercase
+        self.tempo_points = 0
+        # (track index, item index) -> active take, in timeline order, as in `lambdaw.scan_items`
+        self.takes = {}
+        self.parse()
+
+    def parse(self):
+        stack, starts = [], []
+        track_index = item_index = -1
+        item_takes = take = None
+        for index, line in enumerate(self.lines):
+            line = line.strip()
+            parent = stack[-1] if stack else None
+            if line.startswith("<"):
+                name, *fields = split_line(line[1:]) or [""]
+                if name == "TRACK" and parent == "REAPER_PROJECT":
+                    track_index += 1
+                    item_index = -1
+                elif name == "ITEM" and parent == "TRACK":
+                    item_index += 1
+                    position = length = 0
+                    take = Take(0, 0)
+                    item_takes = [take]
+                elif parent == "ITEM" and name == "SOURCE" and take.source is None:
+                    take.source_type = fields[0] if fields else None
+                elif parent == "ITEM" and name == "TAKEFX":
+                    take.has_fx = True
+                elif parent == "ITEM" and name in ("VOLENV", "PANENV", "MUTEENV", "PITCHENV"):
+                    take.has_envelopes = True
+                stack.append(name)
+                starts.append(index)
+            elif line.startswith(">"):
+                if not stack:
+                    continue
+                name, start = stack.pop(), starts.pop()
+                parent = stack[-1] if stack else None
+                if name == "SOURCE" and parent == "ITEM" and take.source is None:
+                    take.source = (start, index + 1)
+                elif name == "ITEM":
+                    active = next((take for take in item_takes if take.selected), item_takes[0])
+                    # Every take has a source chunk, except in items without takes, and empty ("TAKE NULL") takes.
+                    if active.source is not None:
+                        active.position, active.length = position, length
+                        self.takes[track_index, item_index] = active
+            else:
+                fields = split_line(line)
+                if not fields:
+                    continue
+                if parent == "REAPER_PROJECT":
+                    if fields[0] == "TEMPO" and len(fields) > 2:
+                        self.bpm, self.bpi = float(fields[1]), int(fields[2])
+                    elif fields[0] == "SAMPLERATE" and len(fields) > 2 and fields[2] != "0":
+                        # The project's sample rate, if it sets one (see `lambdaw.project_sample_rate`).
+                        self.sample_rate = int(fields[1])
+                elif parent == "ITEM":
+                    if fields[0] == "POSITION":
+                        position = float(fields[1])
+                    elif fields[0] == "LENGTH":
+                        length = float(fields[1])
+                    elif fields[0] == "TAKE":
+                        # Takes after the first are introduced by "TAKE" lines, flagged "SEL" for the active one.
+                        take = Take(0, 0)
+                        take.selected = "SEL" in fields[1:]
+                        item_takes.append(take)
+                    else:
+                        take.fields[fields[0]] = fields[1:]
+                elif parent == "SOURCE" and stack[-2:-1] == ["ITEM"] and fields[0] == "FILE" and len(fields) > 1:
+                    take.file = fields[1]
+                elif parent == "TEMPOENVEX" and fields[0] == "PT":
+                    self.tempo_points += 1
+                elif len(stack) > 1 and stack[-2] == "EXTSTATE" and len(fields) > 1:
+                    self.ext_state[parent.lower(), fields[0].lower()] = fields[1]
+
+    def snippets(self):
+        # Take ID -> (var_name, expression, track_index, item_index, take), as in `lambdaw.scan_items`.
+        snippets = {}
+        for (track_index, item_index), take in self.takes.items():
+            var_name, *expression = take.name.split("=", 1)
+            snippets[track_index, item_index] = (var_name, expression[0] if expression else None, track_index, item_index, take)
+        return snippets
+
+    def source_path(self, take):
+        return take.file if os.path.isabs(take.file) else os.path.join(self.directory, take.file)
+
+    def write(self, path, sources):
+        # Save a copy of the project with new source chunks for some takes (take -> lines).
+        lines = list(self.lines)
+        for take, source in sorted(sources.items(), key=lambda pair: pair[0].source, reverse=True):
+            start, end = take.source
+            reference = lines[start] if start < len(lines) else lines[start - 1]
+            indent = reference[:len(reference) - len(reference.lstrip())]
+            lines[start:end] = [indent + ("  " if 0 < i < len(source) - 1 else "") + line for i, line in enumerate(source)]
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf8", errors="surrogateescape") as f:
+            f.write("\n".join(lines))
+        os.replace(tmp_path, path)
+
+def read_take(project, take, sample_rate):
+    # A take's contents, in the form lambdaw sends to workers (see `lambdaw.to_wire`).
+    if take.source_type == "MIDI":
+        parsed = notearray.parse_source(project.lines[take.source[0]:take.source[1]])
+        if not parsed:
+            raise ValueError(f"{take.name!r} has no MIDI data in the project (pooled MIDI isn't supported)")
+        ticks, notes = parsed
+        seconds_per_tick = 60 / (project.bpm * ticks * take.number("PLAYRATE", 0, 1))
+        return notes.retime(lambda ppq: ppq * seconds_per_tick)
+    if take.source_type != "WAVE" or take.file is None:
+        raise ValueError(f"{take.name!r} has a {take.source_type} source, which can't be read without REAPER")
+    if (take.number("PLAYRATE", 0, 1) != 1 or take.number("PLAYRATE", 2, 0) != 0 or take.number("TAKEVOLPAN", 1, 1) != 1
+            or take.number("CHANMODE", 0, 0) != 0 or take.has_fx or take.has_envelopes or "SM" in take.fields):
+        raise ValueError(f"{take.name!r} has FX, envelopes, stretching, a channel mode, or a rate, pitch or volume change, "
+                         "which need REAPER")
+    return read_audio(project.source_path(take), take.number("SOFFS", 0, 0), take.length, sample_rate)
+
+def read_audio(path, start, length, sample_rate):
+    with render.WaveFile(path, packed=True) as wave:
+        if wave.sample_rate != sample_rate:
+            raise ValueError(f"{path} is at {wave.sample_rate} Hz rather than the project's {sample_rate} Hz")
+        offset = round(start * sample_rate)
+        return wave.read(0, offset, offset + int(length * sample_rate))
+
+def start_pool(lambdaw_dir, size, python, sample_rate):
+    # Start the workers and load the project module, waiting until every worker has it loaded.
+    pool = worker.Pool(lambdaw_dir, size, python)
+    pool.load(os.path.join(lambdaw_dir, "project.py"), sample_rate)
+    loading = set(pool.workers)
+    while loading:
+        select.select([w.sock for w in loading], [], [])
+        for w in list(loading):
+            for message in w.poll():
+                if message[0] == "loaded":
+                    loading.discard(w)
+                    if message[1] is not None:
+                        pool.close()
+                        raise RuntimeError("project module failed to load:\n" + message[1])
+    return pool
+
+def render_project(project, pool, sample_rate, sample_format, time_limit, profiler):
+    # Render every expression take. Returns new source chunks for the takes that rendered (take -> lines).
+    lambdaw_dir = os.path.join(project.directory, "lambdaw")
+    audio_dir = os.path.join(lambdaw_dir, "audio")
+    render_cache = cache.RenderCache(audio_dir)
+    project_index = cache.ProjectIndex(lambdaw_dir)
+    cycle_length = project.bpi / project.bpm * 60  # seconds, as `lambdaw.CYCLE_LENGTH`
+    snippets = project.snippets()
+    graph = deps.DependencyGraph(snippets)
+    # Variable name -> take ID holding its value (the last one, if several items share a name).
+    definitions = {var_name: id for id, (var_name, *_) in snippets.items()}
+    order, cyclic = graph.sort([id for id, (_, expression, *_) in snippets.items() if expression is not None])
+    for id in sorted(cyclic):
+        var_name, expression, *_, take = snippets[id]
+        record = profiler.start(var_name, expression, take.fields.get("GUID", [None])[0])
+        record["error"] = True
+        profiler.finish(record)
+        print(f"{var_name}: not rendered, because it depends on itself", file=sys.stderr)
+
+    # Take ID -> how many expressions yet to start read it. Contents are only kept in memory while they're still needed.
+    readers = {}
+    for id in order:
+        for name in deps.free_names(snippets[id][1]) & definitions.keys():
+            readers[definitions[name]] = readers.get(definitions[name], 0) + 1
+    values = {}  # take ID -> contents, for inputs and finished MIDI renders
+    rendered = {}  # take ID -> path of its new audio, read when (and if) a later expression uses it
+    sources = {}
+    def read_value(id):
+        if id not in values:
+            take = snippets[id][4]
+            if id in rendered:
+                # Read like any other audio take (played from the start of the file).
+                values[id] = read_audio(rendered[id], 0, take.length, sample_rate)
+            else:
+                values[id] = read_take(project, take, sample_rate)
+        return values[id]
+
+    pending = list(order)
+    running = {}  # worker -> (take ID, request ID, target)
+    while pending or running:
+        # Start every job whose dependencies have all finished, in order, while there are idle workers.
+        unfinished = set(pending) | {id for id, *_ in running.values()}
+        for id in list(pending):
+            idle = [w for w in pool.workers if w not in running]
+            if not idle:
+                break
+            if graph.dependencies(id) & unfinished:
+                continue
+            pending.remove(id)
+            var_name, expression, track_index, item_index, take = snippets[id]
+            names = deps.free_names(expression) & definitions.keys()
+            try:
+                bindings = {name: read_value(definitions[name]) for name in names}
+            except Exception as e:
+                bindings = None
+                record = profiler.start(var_name, expression, take.fields.get("GUID", [None])[0])
+                record["error"] = True
+                profiler.finish(record)
+                print(f"{var_name}: couldn't read inputs: {e}", file=sys.stderr)
+                unfinished.discard(id)
+            for name in names:
+                readers[definitions[name]] -= 1
+                if not readers[definitions[name]]:
+                    values.pop(definitions[name], None)
+            if bindings is None:
+                continue
+            bindings["sr"] = sample_rate
+            path = os.path.join(audio_dir, f"track{track_index}_item{item_index}_{time.monotonic_ns()}.wav")
+            target = worker.Target(path, int(take.length * sample_rate), sample_rate, sample_format,
+                                   (take.position, take.length, cycle_length), time_limit)
+            running[idle[0]] = (id, idle[0].submit(expression, bindings, (track_index, item_index, target)), target)
+
+        if not running:
+            continue
+        ready, _, _ = select.select([w.sock for w in running], [], [])
+        for w in [w for w in running if w.sock in ready]:
+            id, request_id, target = running[w]
+            try:
+                messages = w.poll()
+            except (EOFError, OSError):
+                messages = [("error", request_id, "lambdaw worker exited while evaluating " + snippets[id][1])]
+                del running[w]
+                pool.restart(w)
+            for message in messages:
+                if message[0] == "loaded" or message[1] != request_id:
+                    continue
+                running.pop(w, None)
+                var_name, expression, track_index, item_index, take = snippets[id]
+                record = profiler.start(var_name, expression, take.fields.get("GUID", [None])[0])
+                if message[0] == "error":
+                    record["error"] = True
+                    print(f"{var_name}: error\n{message[2]}", file=sys.stderr)
+                else:
+                    result = message[2]
+                    record["eval_time"] = result.get("eval_time", 0)
+                    record["convert_time"] = result.get("convert_time", 0)
+                    if result["kind"] == "midi":
+                        notes = result["notes"]
+                        if not isinstance(notes, NoteArray):
+                            notes = NoteArray.from_notes(notes)
+                        record["notes"] = len(notes)
+                        if readers.get(id):
+                            values[id] = notes
+                        beats_per_second = project.bpm / 60 * take.number("PLAYRATE", 0, 1)
+                        def to_ppq(time):
+                            return round(time * beats_per_second * MIDI_TICKS)
+                        sources[take] = render.midi_source(render.note_events(notes, to_ppq), MIDI_TICKS, to_ppq(take.length))
+                    else:
+                        record["frames"] = result.get("frames", 0)
+                        record["bytes"] = result.get("bytes", 0)
+                        path = rendered[id] = render_cache.dedupe(result["path"])
+                        sources[take] = ["<SOURCE WAVE", "FILE " + quote(os.path.relpath(path, project.directory)), ">"]
+                        # lambdaw's render keys depend on REAPER's view of the inputs, so the key is left for lambdaw
+                        # to fill in when it adopts the render.
+                        guid = take.fields.get("GUID", [None])[0]
+                        render_cache.add(cache.fingerprint("batch_render", guid, expression, sample_rate, sample_format), path)
+                        if guid is not None:
+                            project_index.set(guid, expression, None, path)
+                profiler.finish(record)
+    render_cache.save()
+    project_index.save()
+    return sources
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a REAPER project's lambdaw expressions, without REAPER.")
+    parser.add_argument("project", help=".RPP file")
+    parser.add_argument("--output", help="where to save the project with its renders (default: next to it, as NAME-rendered.RPP)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes rendering in parallel")
+    parser.add_argument("--python", default=sys.executable, help="interpreter to run workers with")
+    parser.add_argument("--sample-rate", type=int, help="override the project's sample rate")
+    parser.add_argument("--sample-format", choices=render.SAMPLE_FORMATS, help="override the project's sample format")
+    parser.add_argument("--time-limit", type=float, help="seconds each render may take (0 for no limit; default: the project's setting)")
+    parser.add_argument("--profile", help="save a record of each render as JSON (or CSV, if the path ends in .csv)")
+    args = parser.parse_args()
+
+    project = RppProject(args.project)
+    if project.tempo_points > 1:
+        print("warning: tempo changes are ignored; rendering at the project's initial tempo", file=sys.stderr)
+    sample_rate = args.sample_rate or project.sample_rate
+    sample_format = args.sample_format or project.ext_state.get(("lambdaw", "sample_format"), "int16")
+    if sample_format not in render.SAMPLE_FORMATS:
+        sample_format = "int16"
+    time_limit = render.parse_time_limit(args.time_limit if args.time_limit is not None
+                                         else project.ext_state.get(("lambdaw", "time_limit")))
+    lambdaw_dir = os.path.join(project.directory, "lambdaw")
+    os.makedirs(os.path.join(lambdaw_dir, "audio"), exist_ok=True)
+    module_path = os.path.join(lambdaw_dir, "project.py")
+    if not os.path.exists(module_path):
+        open(module_path, "a").close()
+
+    start = time.perf_counter()
+    try:
+        pool = start_pool(lambdaw_dir, max(1, args.workers), args.python, sample_rate)
+    except RuntimeError as e:
+        sys.exit(str(e))
+    load_time = time.perf_counter() - start
+    profiler = profiling.Profiler()
+    start = time.perf_counter()
+    try:
+        sources = render_project(project, pool, sample_rate, sample_format, time_limit, profiler)
+    finally:
+        pool.close()
+    render_time = time.perf_counter() - start
+
+    output = args.output or os.path.splitext(project.path)[0] + "-rendered.RPP"
+    project.write(output, sources)
+    if args.profile:
+        profiler.dump(args.profile)
+    records = list(profiler.records)
+    errors = sum(record["error"] for record in records)
+    frames = sum(record["frames"] for record in records)
+    print(profiler.format_summary(limit=None), end="")
+    print(f"{len(records) - errors} rendered, {errors} failed in {render_time:.2f}s with {len(pool.workers)} workers "
+          f"(plus {load_time:.2f}s loading): {(len(records) - errors) / render_time:.2f} renders/s, "
+          f"{frames / sample_rate / render_time:.1f}x realtime")
+    print(f"saved {output}")
+    if errors:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+# Benchmark lambdaw's hot paths outside REAPER, on a synthetic project (see mock_reapy.py).
+# Usage: python benchmark.py [--tracks N] [--items N] [--output results.json] [--compare previous.json]
+# Each stage is timed over several runs, then run once more under tracemalloc to measure its peak memory use.
+import argparse
+import array
+import json
+import math
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import mock_reapy
+
+PROJECT_MODULE = """
+import array
+import itertools
+import math
+
+def transpose(notes, amount):
+    return [{**note, "pitch": note["pitch"] + amount} for note in notes]
+
+def gain(samples, amount):
+    return array.array('d', (x * amount for x in samples))
+"""
+
+def build_project(path, tracks, items, seconds, notes):
+    # Each track has an audio input and a MIDI input, followed by expressions of various kinds that use them.
+    import render
+    project = mock_reapy.Project.create(path)
+    os.makedirs(os.path.join(path, "lambdaw", "audio"), exist_ok=True)
+    with open(os.path.join(path, "lambdaw", "project.py"), "w") as f:
+        f.write(PROJECT_MODULE)
+    for t in range(tracks):
+        track = project.add_track(f"track {t}")
+        position = 0
+        def add_take(name):
+            nonlocal position
+            take = track.add_item(position, position + seconds).add_take()
+            take.name = name
+            position += seconds
+            return take
+        input_path = os.path.join(path, f"input{t}.wav")
+        frequency = 110 * (t + 1)
+        render.generate_wave(input_path, (math.sin(2 * math.pi * frequency * i / render.SAMPLE_RATE) for i in range(int(seconds * render.SAMPLE_RATE))))
+        add_take(f"in{t}").source = mock_reapy.Source("WAVE", input_path)
+        midi_take = add_take(f"n{t}")
+        for i in range(notes):
+            start = i * seconds / notes
+            midi_take.add_note(start, start + seconds / notes, 48 + (i * 7 + t) % 24)
+        expressions = [
+            f"(math.sin(2*math.pi*{frequency}*i/sr) for i in itertools.count())",
+            f"gain(in{t}, 0.5)",
+            f"[{{'start': i*{seconds / notes}, 'end': (i+1)*{seconds / notes}, 'pitch': 60+i%12}} for i in range({notes})]",
+            f"transpose(n{t}, 12)",
+        ]
+        for i in range(items):
+            add_take(f"e{t}_{i}={expressions[i % len(expressions)]}")
+    return project
+
+def measure(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"min": min(times), "median": statistics.median(times), "mean": statistics.mean(times), "peak_memory": peak_memory}
+
+def stages(lambdaw, project, seconds, notes):
+    scratch = project.add_track("scratch").add_item(0, seconds).add_take()
+    samples = array.array('d', (math.sin(i / 10) for i in range(int(seconds * lambdaw.sample_rate))))
+    note_list = [{"start": i * seconds / notes, "end": (i + 1) * seconds / notes, "pitch": 60 + i % 12} for i in range(notes)]
+    wave_path = os.path.join(lambdaw.audio_dir, "benchmark.wav")
+    dense = project.add_track("dense").add_item(0, seconds).add_take()
+    for i in range(10000):
+        dense.add_note(i * seconds / 10000, (i + 4) * seconds / 10000, 36 + i % 48)
+
+    def full_scan():
+        lambdaw.scanned_tracks = {}
+        lambdaw.scan_items(force=True)
+
+    def collect_garbage():
+        lambdaw.gc_pending = True
+        lambdaw.collect_garbage(force=True)
+
+    def convert_inputs():
+        lambdaw.block_cache.clear()
+        for *_, take in lambdaw.snippets.values():
+            value = lambdaw.convert_input(take)
+            if isinstance(value, lambdaw.AudioInput):
+                value.read()
+        lambdaw.close_inputs()
+
+    return {
+        "load": lambdaw.load,
+        "scan_items (unchanged)": lambdaw.scan_items,
+        "scan_items (full)": full_scan,
+        "execute (idle)": lambda: lambdaw.execute(""),
+        "eval_takes (uncached)": lambda: lambdaw.eval_takes(list(lambdaw.snippets.values()), use_cache=False),
+        "execute eval_all (cached)": lambda: lambdaw.execute("eval_all"),
+        "convert_input": convert_inputs,
+        "convert_input (10k notes)": lambda: lambdaw.convert_input(dense),
+        "convert_output (audio)": lambda: lambdaw.convert_output(samples, 0, 0, scratch),
+        "convert_output (midi)": lambda: lambdaw.convert_output([dict(note) for note in note_list], 0, 0, scratch),
+        "generate_wave (samples)": lambda: lambdaw.generate_wave(wave_path, (math.sin(i / 10) for i in range(len(samples)))),
+        "generate_wave (buffer)": lambda: lambdaw.generate_wave(wave_path, samples),
+        "collect_garbage": collect_garbage,
+        "reconcile_files": lambdaw.reconcile_files,
+    }
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark lambdaw on a synthetic project, outside REAPER.")
+    parser.add_argument("--tracks", type=int, default=8)
+    parser.add_argument("--items", type=int, default=8, help="expression items per track")
+    parser.add_argument("--seconds", type=float, default=2, help="length of each item")
+    parser.add_argument("--notes", type=int, default=64, help="notes per MIDI item")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--stage", action="append", help="only run stages starting with this (may be repeated)")
+    parser.add_argument("--output", help="save results as JSON")
+    parser.add_argument("--compare", help="compare with results saved by an earlier run")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="lambdaw-benchmark-")
+    cwd = os.getcwd()
+    try:
+        project = build_project(directory, args.tracks, args.items, args.seconds, args.notes)
+        sys.modules["reapy"] = mock_reapy
+        import lambdaw
+        results = {}
+        for name, fn in stages(lambdaw, project, args.seconds, args.notes).items():
+            if args.stage and not any(name.startswith(prefix) for prefix in args.stage):
+                continue
+            del mock_reapy.messages[:]
+            results[name] = measure(fn, args.repeat)
+            errors = [text for kind, text in mock_reapy.messages if kind == "message box"]
+            if errors:
+                results[name]["errors"] = len(errors)
+                print(f"{name}: {errors[0]}", file=sys.stderr)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["stages"]
+    print(f"{'stage':<28}{'median':>12}{'min':>12}{'peak memory':>14}" + (f"{'vs. previous':>14}" if previous else ""))
+    for name, result in results.items():
+        line = f"{name:<28}{result['median'] * 1000:>10.2f}ms{result['min'] * 1000:>10.2f}ms{result['peak_memory'] / 1024:>12.0f}KB"
+        if name in previous:
+            line += f"{result['median'] / previous[name]['median']:>13.2f}x"
+        print(line)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"version": git_version(), "python": sys.version, "time": time.time(), "config": vars(args), "stages": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
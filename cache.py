@@ -0,0 +1,150 @@
+# Cache of rendered audio, keyed by content.
+# A render is identified by everything that determines its contents (expression, inputs, length, sample rate, project module),
+# so when none of those have changed, the existing WAV (and its .reapeaks) can be reused instead of re-rendering.
+# Renders are also indexed by a hash of the audio itself, so a re-render that comes out identical reuses the existing file.
+import hashlib
+import json
+import os
+import time
+
+MAX_BYTES = 2 * 1024**3
+
+def fingerprint(*parts):
+    return hashlib.blake2b(repr(parts).encode("utf8"), digest_size=16).hexdigest()
+
+def load_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_json(path, data):
+    # Write to a temporary file first, so an interrupted save doesn't lose the existing file.
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def file_digest(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class RenderCache:
+    def __init__(self, directory, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, "cache.json")
+        # key -> {"file": name in directory, "size": bytes, "used": timestamp, "content": digest of file}
+        self.entries = load_json(self.index_path)
+        self.files = {}  # file name -> keys
+        self.contents = {}  # content digest -> file name
+        for key, entry in self.entries.items():
+            self.files.setdefault(entry["file"], set()).add(key)
+            self.contents[entry.get("content")] = entry["file"]
+        self.contents.pop(None, None)
+        self.dirty = False
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        path = os.path.join(self.directory, entry["file"])
+        if not os.path.exists(path):
+            self.remove(key)
+            return None
+        entry["used"] = time.time()
+        self.dirty = True
+        return path
+
+    def add(self, key, path):
+        if key in self.entries:
+            self.remove(key)
+        name = os.path.basename(path)
+        keys = self.files.setdefault(name, set())
+        # Files shared by several keys keep the content digest computed for the first one.
+        content = self.entries[next(iter(keys))].get("content") if keys else file_digest(path)
+        self.entries[key] = {"file": name, "size": os.path.getsize(path), "used": time.time(), "content": content}
+        keys.add(key)
+        self.contents[content] = name
+        self.dirty = True
+
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        keys = self.files[entry["file"]]
+        keys.discard(key)
+        if not keys:
+            del self.files[entry["file"]]
+            if self.contents.get(entry.get("content")) == entry["file"]:
+                del self.contents[entry["content"]]
+        self.dirty = True
+
+    def dedupe(self, path):
+        # If a cached file has exactly the same contents as the new render at `path`, delete the new one and return the
+        # cached one instead, so its peaks don't need to be built again. Otherwise, return `path`.
+        name = self.contents.get(file_digest(path))
+        if name is None or name == os.path.basename(path):
+            return path
+        existing = os.path.join(self.directory, name)
+        if not os.path.exists(existing):
+            return path
+        os.unlink(path)
+        return existing
+
+    def evict(self, unused):
+        # Given unused lambdaw-generated files, return the ones to delete:
+        # everything that isn't cached, plus the least recently used cache entries beyond the size limit.
+        delete = {path for path in unused if os.path.basename(path) not in self.files}
+        sizes = {name: self.entries[next(iter(keys))]["size"] for name, keys in self.files.items()}
+        total = sum(sizes.values())
+        def last_used(path):
+            return max(self.entries[key]["used"] for key in self.files[os.path.basename(path)])
+        for path in sorted(unused - delete, key=last_used):
+            if total <= self.max_bytes:
+                break
+            name = os.path.basename(path)
+            total -= sizes[name]
+            for key in list(self.files[name]):
+                self.remove(key)
+            delete.add(path)
+        return delete
+
+    def save(self):
+        if not self.dirty:
+            return
+        save_json(self.index_path, self.entries)
+        self.dirty = False
+
+class ProjectIndex:
+    # What each expression take was last rendered from, and into. This persists across REAPER sessions,
+    # so a take that is still up to date can be recognized without evaluating (or even looking up) anything.
+    def __init__(self, directory):
+        self.path = os.path.join(directory, "index.json")
+        # take GUID -> {"expression": str, "key": render key, "file": name in audio directory (None for MIDI), "peaks": bool,
+        #               "span": [item position, cycle length] for patterns, whose notes depend on them too (else None),
+        #               "midi_hash": `MIDI_GetHash` of the notes it was given, for MIDI}
+        self.entries = load_json(self.path)
+        self.dirty = False
+
+    def get(self, guid):
+        return self.entries.get(guid)
+
+    def set(self, guid, expression, key, path=None, peaks=False, span=None, midi_hash=None):
+        self.entries[guid] = {"expression": expression, "key": key, "file": None if path is None else os.path.basename(path),
+                              "peaks": peaks, "span": span, "midi_hash": midi_hash}
+        self.dirty = True
+
+    def prune(self, guids):
+        # Forget takes other than `guids`.
+        for guid in self.entries.keys() - guids:
+            del self.entries[guid]
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        save_json(self.path, self.entries)
+        self.dirty = False
@@ -0,0 +1,3 @@
+import reapy
+
+reapy.set_ext_state("lambdaw", "pending", "cancel")
@@ -0,0 +1,82 @@
+# Dependencies between expression items.
+# An expression depends on every item whose variable name it reads, so when an item changes,
+# everything downstream of it has to be re-evaluated (in order) to stay up to date.
+import functools
+import symtable
+
+@functools.lru_cache(maxsize=4096)
+def free_names(expression):
+    # Names the expression reads from its namespace.
+    # Variables bound inside the expression (comprehension targets, lambda arguments, walrus targets) don't count.
+    try:
+        table = symtable.symtable("(" + expression + ")", "<expression>", "eval")
+    except SyntaxError:
+        return frozenset()
+    local = {symbol.get_name() for symbol in table.get_symbols() if symbol.is_assigned()}
+    names = {symbol.get_name() for symbol in table.get_symbols() if symbol.is_referenced()}
+    stack = table.get_children()
+    while stack:
+        child = stack.pop()
+        stack.extend(child.get_children())
+        # Only implicit globals refer to the namespace; free variables refer to enclosing scopes within the expression.
+        names |= {symbol.get_name() for symbol in child.get_symbols()
+                  if symbol.is_referenced() and symbol.is_global() and not symbol.is_declared_global()}
+    names -= local
+    return frozenset(names)
+
+class DependencyGraph:
+    def __init__(self, snippets):
+        # `snippets` maps take ID -> (var_name, expression, track_index, item_index, take), as in `lambdaw.scan_items`.
+        # Its iteration order (timeline order) is used to break ties, so evaluation order is deterministic.
+        self.snippets = snippets
+        self.order = {id: i for i, id in enumerate(snippets)}
+        self.definitions = {}  # var_name -> take IDs
+        self.dependents = {}  # var_name -> take IDs of expressions that read it
+        for id, (var_name, expression, *_) in snippets.items():
+            self.definitions.setdefault(var_name, set()).add(id)
+            if expression is not None:
+                for name in free_names(expression):
+                    self.dependents.setdefault(name, set()).add(id)
+
+    def dependencies(self, id):
+        expression = self.snippets[id][1]
+        if expression is None:
+            return set()
+        return {dep for name in free_names(expression) for dep in self.definitions.get(name, ()) if dep != id}
+
+    def downstream(self, ids):
+        # All takes in `ids`, plus everything that transitively depends on them.
+        seen = set()
+        stack = [id for id in ids if id in self.snippets]
+        while stack:
+            id = stack.pop()
+            if id in seen:
+                continue
+            seen.add(id)
+            stack.extend(self.dependents.get(self.snippets[id][0], ()))
+        return seen
+
+    def sort(self, ids):
+        # Order `ids` so that each take comes after the takes (within `ids`) that it depends on.
+        # Returns (ordered IDs, IDs involved in or downstream of a cycle).
+        ids = set(ids)
+        dependencies = {id: self.dependencies(id) & ids for id in ids}
+        ready = sorted((id for id, deps in dependencies.items() if not deps), key=self.order.get)
+        ordered = []
+        while ready:
+            id = ready.pop(0)
+            ordered.append(id)
+            newly_ready = []
+            for dependent in self.dependents.get(self.snippets[id][0], ()):
+                if dependent in dependencies and id in dependencies[dependent]:
+                    dependencies[dependent].discard(id)
+                    if not dependencies[dependent]:
+                        newly_ready.append(dependent)
+            ready = sorted(ready + newly_ready, key=self.order.get)
+        return ordered, ids - set(ordered)
+
+    def evaluation_order(self, ids):
+        # Takes to re-evaluate after `ids` changed, in dependency order,
+        # plus the variable names of any takes that can't be evaluated because of a cycle.
+        ordered, cyclic = self.sort(self.downstream(ids))
+        return ordered, {self.snippets[id][0] for id in cyclic}
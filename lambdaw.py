@@ -1,130 +1,407 @@
 import array
+import builtins
+import collections
 import importlib
 import itertools
+import math
 import os
 from pathlib import Path
 import sys
 import time
 import traceback
-import wave
+import weakref
 
 import reapy
 
-SAMPLE_RATE = 48000
+from render import SAMPLE_RATE, generate_wave, peek
+from memo import memoize
+from models import model_server
+from notearray import NoteArray
+import cache
+import deps
+import memo
+import notearray
+import patterns
+import profiling
+import render
+import worker
 
-def generate_wave(path, it):
-    # NOTE: Avoiding numpy due to segfault on reload: https://github.com/numpy/numpy/issues/11925
-    wav = wave.open(path, "w")
-    wav.setnchannels(1)
-    wav.setsampwidth(2)
-    wav.setframerate(SAMPLE_RATE)
-    scale = 2**15 - 1
-    audio = array.array('h', (int(max(-1, min(x, 1)) * scale) for x in it))
-    wav.writeframes(audio)
-    wav.close()
+STATE_CHUNK_SIZE = 4*1024*1024  # see reaper_python's `rpr_packs()`
 
 def create_midi_source(take):
     # Create a new, blank MIDI source that is the length of its container.
     # This is weirdly complicated. See https://forum.cockos.com/showthread.php?t=100864.
-    size = 4*1024*1024  # see reaper_python's `rpr_packs()`
     source = reapy.RPR.PCM_Source_CreateFromType("MIDI")
     reapy.RPR.SetMediaItemTake_Source(take.id, source)
+    release_file(take.id)
+    set_midi_events(take, ())
+
+def set_midi_events(take, events):
+    # Replace the contents of the take's MIDI source with `events`, a sorted list of (PPQ, flags, message),
+    # by rewriting the item's state chunk. This takes a constant number of API calls, however many events there are.
+    size = STATE_CHUNK_SIZE
     ticks = int(reapy.RPR.get_config_var_string("miditicksperbeat", 0, size)[2])
     state = reapy.RPR.GetItemStateChunk(take.item.id, 0, size, True)[2]
     project = reapy.Project()
     start = project.time_to_beats(take.item.position)
     end = project.time_to_beats(take.item.position + take.item.length)
-    payload = f"""
-<SOURCE MIDI
-HASDATA 1 {ticks} QN
-E {int(ticks*(end - start))} b0 7b 00
->
-""".strip().split("\n")
+    payload = render.midi_source(events, ticks, int(ticks*(end - start)))
     lines = state.split("\n")
-    start_index = next(i for i, line in enumerate(lines) if line.startswith("<SOURCE MIDI"))
-    end_index = lines.index(">", start_index + 1)
+    # The item may have other takes with MIDI sources of their own.
+    start_index = source_index(lines, int(reapy.RPR.GetMediaItemTakeInfo_Value(take.id, "IP_TAKENUMBER")))
+    depth = 0
+    for end_index in range(start_index, len(lines)):
+        line = lines[end_index].lstrip()
+        if line.startswith("<"):
+            depth += 1
+        elif line.startswith(">"):
+            depth -= 1
+            if depth == 0:
+                break
     lines[start_index:end_index + 1] = payload
     state = "\n".join(lines)
     reapy.RPR.SetItemStateChunk(take.item.id, state, size)
 
-def peek(iterable, default=None):
-    it = iter(iterable)
-    try:
-        first = next(it)
-    except StopIteration:
-        return (default, ())
-    return (first, itertools.chain((first,), it))
+# Generated files in use: path -> IDs of the takes using it, and take ID -> path.
+# Kept up to date as sources are swapped, so finding unused files doesn't require walking the whole project.
+file_users = {}
+take_files = {}
+# Generated files that no take uses anymore. Unless cached, they're deleted by the next `collect_garbage`.
+unused_files = set()
+gc_pending = False
+GC_INTERVAL = 5  # seconds; deletions are batched, at most once per interval
+last_collection = 0
 
-def collect_garbage():
-    # Delete unused lambdaw-generated audio files & reapeaks.
-    files = {os.path.join(audio_dir, f) for f in os.listdir(audio_dir) if f.endswith(".wav")}
-    used = set()
-    # TODO: Maybe avoid going through all the project contents again here.
-    # Instead, perhaps we could get this information in `scan_items` and update it appropriately in `eval_takes`.
-    for track in reapy.Project().tracks:
+def use_file(take_id, path):
+    release_file(take_id)
+    path = os.path.abspath(path)
+    if Path(path).is_relative_to(audio_dir):
+        take_files[take_id] = path
+        file_users.setdefault(path, set()).add(take_id)
+        unused_files.discard(path)
+
+def release_file(take_id):
+    global gc_pending
+    path = take_files.pop(take_id, None)
+    if path is not None:
+        users = file_users[path]
+        users.discard(take_id)
+        if not users:
+            del file_users[path]
+            unused_files.add(path)
+            gc_pending = True
+
+def collect_garbage(force=False):
+    # Delete unused lambdaw-generated audio files & reapeaks, if there are any new ones.
+    global gc_pending, last_collection
+    if not gc_pending or (not force and time.monotonic() - last_collection < GC_INTERVAL):
+        return
+    gc_pending = False
+    last_collection = time.monotonic()
+    # Unused renders stay around in the cache (up to its size limit) in case they're needed again.
+    for file in render_cache.evict(unused_files):
+        Path(file).unlink(True)
+        Path(file + ".reapeaks").unlink(True)
+        unused_files.discard(file)
+    render_cache.save()
+
+def reconcile_files():
+    # Rebuild the registry of generated files from scratch, from every take in the project and the files in `audio_dir`.
+    # Only done on load; afterwards, it's updated incrementally.
+    global file_users, take_files, unused_files, gc_pending
+    file_users, take_files, unused_files = {}, {}, set()
+    for track in project.tracks:
         for item in track.items:
             for take in item.takes:
-                used.add(os.path.abspath(take.source.filename))
-    unused = files - used
-    for file in unused:
-        Path(file).unlink()
-        Path(file + ".reapeaks").unlink(True)
+                use_file(take.id, take.source.filename)
+    files = {os.path.join(audio_dir, f) for f in os.listdir(audio_dir) if f.endswith(".wav")}
+    unused_files = files - file_users.keys()
+    gc_pending = True
+    collect_garbage(force=True)
 
 def convert_input(take: reapy.Take):
-    take_start = take.item.position - take.start_offset
-    def convert_note(note):
-        infos = note.infos
-        # TODO: Maybe use beats/PPQ instead of seconds. (The conversion is due to reapy.)
-        infos["dur"] = infos["start"] - infos["end"]
-        infos["start"] -= take_start
-        infos["end"] -= take_start
-        return infos
     if take.is_midi:
-        return [convert_note(note) for note in take.notes]
+        return read_notes(take)
     else:
-        def generator():
-            accessor = take.add_audio_accessor()
-            length = int((accessor.end_time - accessor.start_time) * SAMPLE_RATE)
-            chunk_size = 4096
-            for i in range(0, length, chunk_size):
-                chunk = accessor.get_samples(i / SAMPLE_RATE, chunk_size, sample_rate=SAMPLE_RATE)
-                yield from chunk
-            # TODO: Does accessor still get cleaned up if expression doesn't exhaust this generator?
-            # I suspect not. Might need to implement __del__ on something - ideally reapy's AudioAccessor class.
-            accessor.delete()
-        return generator()
+        return AudioInput(take)
+
+def source_chunk(state, take_number):
+    # Lines of an item's state chunk, starting from the MIDI source of its `take_number`th take (see `notearray.parse_source`),
+    # or None if that take doesn't have one.
+    lines = state.split("\n")
+    index = source_index(lines, take_number)
+    return None if index is None else itertools.islice(lines, index, None)
+
+def source_index(lines, take_number):
+    # Index of the line starting the MIDI source of an item's `take_number`th take, or None if that take doesn't have one.
+    # Takes after the first are introduced by "TAKE" lines at the top level of the item.
+    depth, take = 0, 0
+    for i, line in enumerate(lines):
+        line = line.lstrip()
+        if line.startswith("<"):
+            if depth == 1 and take == take_number and line.startswith("<SOURCE MIDI"):
+                return i
+            depth += 1
+        elif line.startswith(">"):
+            depth -= 1
+        elif depth == 1 and (line == "TAKE" or line.startswith("TAKE ")):
+            take += 1
+            if take > take_number:
+                break
+    return None
+
+def take_blocks(lines, take_number):
+    # (first line, last line) of each chunk nested directly in an item's `take_number`th take (source, FX, envelopes...).
+    depth, take, start = 0, 0, None
+    for i, line in enumerate(lines):
+        line = line.lstrip()
+        if line.startswith("<"):
+            if depth == 1 and take == take_number:
+                start = i
+            depth += 1
+        elif line.startswith(">"):
+            depth -= 1
+            if depth == 1 and start is not None:
+                yield start, i
+                start = None
+        elif depth == 1 and (line == "TAKE" or line.startswith("TAKE ")):
+            take += 1
+            if take > take_number:
+                return
+
+def read_notes(take):
+    # Read all of a MIDI take's notes at once, from its item's state chunk, with times relative to the start of the take.
+    # (MIDI_GetAllEvts would be the obvious choice, but its binary buffer doesn't survive reapy's string conversion;
+    # reading `take.notes` costs several API calls per note.)
+    take_start = take.item.position - take.start_offset
+    state = reapy.RPR.GetItemStateChunk(take.item.id, 0, STATE_CHUNK_SIZE, False)[2]
+    lines = source_chunk(state, int(reapy.RPR.GetMediaItemTakeInfo_Value(take.id, "IP_TAKENUMBER")))
+    parsed = lines is not None and notearray.parse_source(lines)
+    if not parsed:
+        # No event data in the chunk (e.g. a pooled source), so fall back to reading notes one by one.
+        notes = NoteArray.from_notes(note.infos for note in take.notes)
+        return notes.shift(-take_start)
+    ticks, notes = parsed
+    if reapy.RPR.CountTempoTimeSigMarkers(project.id) == 0:
+        # Constant tempo: positions are just scaled.
+        seconds_per_tick = 60 / (project.bpm * ticks * take.get_info_value("D_PLAYRATE"))
+        return notes.retime(lambda ppq: ppq * seconds_per_tick)
+    return notes.retime(lambda ppq: reapy.RPR.MIDI_GetProjTimeFromPPQPos(take.id, ppq) - take_start)
+
+# Decoded blocks of audio inputs, shared by all expressions that read the same source.
+# (source fingerprint, block index) -> array of samples, in least-recently-used order.
+block_cache = collections.OrderedDict()
+BLOCK_CACHE_SIZE = 256  # blocks
+# Inputs with open accessors, which are released after each round of evaluation.
+open_inputs = weakref.WeakSet()
+
+def map_source(take, rate):
+    # Fast path for audio inputs: if the take plays an uncompressed WAV file as it is (no FX, envelopes, stretching,
+    # resampling, channel mode, etc.), its samples can be read straight from the file.
+    # Returns (render.WaveFile, first frame, frames) or None.
+    if take.source.type != "WAVE":
+        return None
+    if (take.get_info_value("D_PLAYRATE") != 1 or take.get_info_value("D_PITCH") != 0 or take.get_info_value("D_VOL") != 1
+            or take.get_info_value("I_CHANMODE") != 0 or reapy.RPR.TakeFX_GetCount(take.id)
+            or reapy.RPR.CountTakeEnvelopes(take.id) or reapy.RPR.GetTakeNumStretchMarkers(take.id)):
+        return None
+    try:
+        wave = render.WaveFile(take.source.filename)
+    except (OSError, ValueError):
+        return None
+    offset = round(take.start_offset * rate)
+    length = int(take.item.length * rate)
+    # Past the end of the file, REAPER loops the source or plays silence, so leave that to the accessor.
+    if wave.sample_rate != rate or offset < 0 or offset + length > wave.frames:
+        return None
+    return wave, offset, length
+
+class AudioInput:
+    # Audio from a take, read on demand through an AudioAccessor, or directly from the file when possible (see `map_source`).
+    # Iterating yields individual samples (like a plain generator); `blocks()`, `read()` and slicing return buffers.
+    def __init__(self, take):
+        self.take = take
+        self.fingerprint = take_fingerprint(take)
+        self.sample_rate = sample_rate
+        self.accessor = None
+        self.length = None
+        self.mapped = None  # result of `map_source`, or False if it doesn't apply
 
+    def map(self):
+        if self.mapped is None:
+            self.mapped = map_source(self.take, self.sample_rate) or False
+            if self.mapped:
+                open_inputs.add(self)
+        return self.mapped
+
+    def open(self):
+        if self.accessor is None:
+            self.accessor = self.take.add_audio_accessor()
+            open_inputs.add(self)
+        return self.accessor
+
+    def close(self):
+        if self.accessor is not None:
+            self.accessor.delete()
+            self.accessor = None
+        # Don't keep the file mapped (which would stop it from being deleted on Windows); it's remapped on demand.
+        if self.mapped:
+            self.mapped = None
+        open_inputs.discard(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def __len__(self):
+        if self.length is None and self.map():
+            self.length = self.mapped[2]
+        if self.length is None:
+            accessor = self.open()
+            self.length = int((accessor.end_time - accessor.start_time) * self.sample_rate)
+        return self.length
+
+    def memo_key(self):
+        # Identifies the audio for `memoize`, without reading it.
+        return ("audio", self.fingerprint, self.sample_rate)
+
+    def view(self, start=0, stop=None):
+        # Samples in [start, stop) without copying them, as a view into the file, if it's a float WAV that can be mapped.
+        # Otherwise, the same as `read`.
+        mapped = self.map()
+        if not mapped or mapped[0].scale is not None:
+            return self.read(start, stop)
+        wave, offset, length = mapped
+        stop = length if stop is None else min(stop, length)
+        return wave.channel(0)[offset + start:offset + max(start, stop)]
+
+    def block(self, index):
+        start = index * render.BLOCK_SIZE
+        mapped = self.map()
+        if mapped and mapped[0].scale is None:
+            return self.view(start, start + render.BLOCK_SIZE)
+        # Blocks read straight from a file are the same for every take playing it as it is (see `map_source`),
+        # but blocks read through an accessor belong to the take, whose FX etc. the fingerprint only summarizes.
+        key = (self.fingerprint if mapped else (self.take.id, self.fingerprint), self.sample_rate, index)
+        block = block_cache.get(key)
+        if block is None:
+            size = min(render.BLOCK_SIZE, len(self) - start)
+            if mapped:
+                wave, offset, _ = mapped
+                block = array.array('d', map((1 / wave.scale).__mul__, wave.channel(0)[offset + start:offset + start + size]))
+            else:
+                block = array.array('d', self.open().get_samples(start / self.sample_rate, size, sample_rate=self.sample_rate))
+            block_cache[key] = block
+            if len(block_cache) > BLOCK_CACHE_SIZE:
+                block_cache.popitem(last=False)
+        else:
+            block_cache.move_to_end(key)
+        return block
+
+    def blocks(self, start=0, stop=None):
+        # Yield the samples in [start, stop) as a sequence of buffers.
+        stop = len(self) if stop is None else min(stop, len(self))
+        for index in range(start // render.BLOCK_SIZE, -(-stop // render.BLOCK_SIZE)):
+            block_start = index * render.BLOCK_SIZE
+            block = self.block(index)
+            if block_start < start or block_start + len(block) > stop:
+                block = block[max(start - block_start, 0):stop - block_start]
+            yield block
+
+    def read(self, start=0, stop=None):
+        mapped = self.map()
+        if mapped and mapped[0].scale is None:
+            return array.array('d', self.view(start, stop))
+        result = array.array('d')
+        for block in self.blocks(start, stop):
+            result.extend(block)
+        return result
+
+    def read_time(self, start, end):
+        return self.read(round(start * self.sample_rate), round(end * self.sample_rate))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            samples = self.read(start, stop) if start < stop else array.array('d')
+            return samples if step == 1 else samples[::step]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("audio input index out of range")
+        return self.block(index // render.BLOCK_SIZE)[index % render.BLOCK_SIZE]
+
+    def __iter__(self):
+        for block in self.blocks():
+            yield from block
+
+def close_inputs():
+    for input in list(open_inputs):
+        input.close()
+
+
+def write_notes(take, notes):
+    # Replace the take's contents with `notes`, all at once.
+    # (Equivalent to clearing the take and calling `take.add_note` for each note, minus an API round-trip per note.)
+    if not take.is_midi:
+        create_midi_source(take)
+    ppq_cache = {}
+    def to_ppq(time):
+        # Computed against the new source, exactly as `take.add_note` would.
+        if time not in ppq_cache:
+            ppq_cache[time] = round(take.time_to_ppq(time))
+        return ppq_cache[time]
+    events = render.note_events(notes, to_ppq)
+    set_midi_events(take, events)
+    if events:
+        reapy.RPR.MIDI_Sort(take.id)
+    profiler.output(notes=len(events) // 2)
+
+def new_audio_path(track_index, item_index):
+    return os.path.join(audio_dir, f"track{track_index}_item{item_index}_{time.monotonic_ns()}.wav")
+
+def swap_source(take, path):
+    source = reapy.RPR.PCM_Source_CreateFromFile(os.path.join(lambdaw_dir, path))
+    old_source = take.source
+    reapy.RPR.SetMediaItemTake_Source(take.id, source)
+    use_file(take.id, path)
+    if Path(old_source.filename).is_relative_to(audio_dir):
+        if old_source.id in peak_jobs:
+            peak_jobs.remove(old_source.id)
+            peak_records.pop(old_source.id, None)
+        reapy.RPR.PCM_Source_Destroy(old_source.id)
 
 def convert_output(output, track_index, item_index, take):
-    def convert_note(note):
-        # NOTE: We don't add back `take_start` here due to reapy inconsistency.
-        if "dur" in note:
-            del note["dur"]
-        return note
-    # Clear current notes
-    while take.n_notes:
-        take.notes[0].delete()
-    if output is None:
-        output = ()
-    peeked = peek(output)
-    first, output = peeked
-    if isinstance(first, dict):
-        if not take.is_midi:
-            create_midi_source(take)
-        for note in output:
-            take.add_note(**convert_note(note))
+    if patterns.is_pattern(output):
+        output = patterns.to_notes(output, take.item.position, take.item.length, CYCLE_LENGTH)
+    is_midi, output = render.split_output(output)
+    if is_midi:
+        write_notes(take, output)
         return False
     else:
-        path = os.path.join(audio_dir, f"track{track_index}_item{item_index}_{time.monotonic_ns()}.wav")
-        generate_wave(path, itertools.islice(output, int(take.item.length * SAMPLE_RATE)))
-
-        source = reapy.RPR.PCM_Source_CreateFromFile(os.path.join(lambdaw_dir, path))
-        old_source = take.source
-        reapy.RPR.SetMediaItemTake_Source(take.id, source)
-        if Path(old_source.filename).is_relative_to(audio_dir):
-            reapy.RPR.PCM_Source_Destroy(old_source.id)
+        path = new_audio_path(track_index, item_index)
+        frames = generate_wave(path, output, int(take.item.length * sample_rate), time_limit=time_limit,
+                               sample_rate=sample_rate, sample_format=sample_format)
+        profiler.output(frames=frames, bytes=os.path.getsize(path))
+        swap_source(take, render_cache.dedupe(path))
         return True
 
+def apply_result(result, take):
+    # Apply the output of an expression evaluated by the worker (see worker.py).
+    if result["kind"] == "midi":
+        write_notes(take, result["notes"])
+        return False
+    elif result["kind"] == "audio":
+        profiler.output(frames=result.get("frames", 0), bytes=result.get("bytes", 0))
+        swap_source(take, render_cache.dedupe(result["path"]))
+        return True
+    return False
+
 input_converter = convert_input
 output_converter = convert_output
 
@@ -135,140 +412,743 @@ def register_converters(input=None, output=None):
     if output is not None:
         output_converter = output
 
-def build_peaks(source):
-    result = reapy.RPR.PCM_Source_BuildPeaks(source.id, 0)
-    if result != 0:
-        while (result := reapy.RPR.PCM_Source_BuildPeaks(source.id, 1)) != 0:
-            pass
-    reapy.RPR.PCM_Source_BuildPeaks(source.id, 2)
+# Sources whose peaks are still being built. Rather than blocking until they're done,
+# `advance_peaks` does a bounded amount of work on each tick of the defer loop.
+peak_jobs = collections.deque()
+PEAK_BUDGET = 0.01  # seconds per tick
+# source ID -> profiler record of the evaluation that produced it, so time spent building its peaks is accounted for
+peak_records = {}
+
+def build_peaks(source, record=None):
+    if has_peaks(os.path.abspath(source.filename)):
+        return  # e.g. a cached or deduplicated render
+    start = time.perf_counter()
+    if reapy.RPR.PCM_Source_BuildPeaks(source.id, 0) != 0:
+        peak_jobs.append(source.id)
+        if record is not None:
+            peak_records[source.id] = record
+    else:
+        reapy.RPR.PCM_Source_BuildPeaks(source.id, 2)
+    if record is not None:
+        record["peaks_time"] += time.perf_counter() - start
+
+def advance_peaks():
+    deadline = time.perf_counter() + PEAK_BUDGET
+    finished = False
+    while peak_jobs and time.perf_counter() < deadline:
+        source_id = peak_jobs[0]
+        if not reapy.RPR.ValidatePtr2(project.id, source_id, "PCM_source*"):
+            # Freed since it was queued (undone, deleted, or its project closed).
+            peak_jobs.popleft()
+            peak_records.pop(source_id, None)
+            continue
+        start = time.perf_counter()
+        done = reapy.RPR.PCM_Source_BuildPeaks(source_id, 1) == 0
+        if done:
+            reapy.RPR.PCM_Source_BuildPeaks(source_id, 2)
+            peak_jobs.popleft()
+            finished = True
+        if source_id in peak_records:
+            peak_records[source_id]["peaks_time"] += time.perf_counter() - start
+            if done:
+                del peak_records[source_id]
+    if finished:
+        reapy.update_arrange()
+
+def has_peaks(path):
+    return os.path.exists(path + ".reapeaks")
+
+def input_fingerprint(name):
+    # Inputs are identified by their source and state rather than their (converted) contents.
+    take = definitions[name]
+    # The source pointer (the first part of the state) changes between REAPER sessions, unlike everything else here.
+    return (take_fingerprint(take), take_state(take)[1:])
+
+def take_fingerprint(take):
+    # MIDI sources stored in the project have no file (and `abspath("")` would be the working directory).
+    filename = take.source.filename and os.path.abspath(take.source.filename)
+    try:
+        stat = os.stat(filename)
+        file_info = (stat.st_size, stat.st_mtime_ns)
+    except OSError:
+        file_info = None
+    processing = None if take.is_midi else take_processing(take)
+    return (filename, file_info, take.start_offset, take.item.length, take.get_info_value("D_PLAYRATE"), processing)
+
+def take_processing(take):
+    # What an audio take does to its source besides playing it: pitch, volume, FX and envelopes.
+    # FX and envelope settings are only available from the item's state chunk, which is only fetched if the take has any.
+    effects = None
+    if reapy.RPR.TakeFX_GetCount(take.id) or reapy.RPR.CountTakeEnvelopes(take.id):
+        lines = reapy.RPR.GetItemStateChunk(take.item.id, 0, STATE_CHUNK_SIZE, False)[2].split("\n")
+        take_number = int(reapy.RPR.GetMediaItemTakeInfo_Value(take.id, "IP_TAKENUMBER"))
+        effects = cache.fingerprint([lines[start:end + 1] for start, end in take_blocks(lines, take_number)
+                                     if not lines[start].lstrip().startswith("<SOURCE")])
+    return (take.get_info_value("D_PITCH"), take.get_info_value("D_VOL"), effects)
+
+def render_key(expression, take):
+    inputs = [(name, input_fingerprint(name)) for name in sorted(deps.free_names(expression)) if name in definitions]
+    return cache.fingerprint(expression, inputs, round(take.item.length, 9), sample_rate, sample_format, module_version)
+
+def take_span(take):
+    # What a pattern's notes depend on besides the render key: the cycles its item spans (see patterns.py).
+    return [round(take.item.position, 9), CYCLE_LENGTH]
+
+def use_cached_render(key, var_name, take):
+    # Point the take at an earlier render of the same expression and inputs, if there is one.
+    # Returns None on a cache miss, otherwise whether the take's source had to be replaced.
+    path = render_cache.get(key)
+    if path is None:
+        return None
+    if os.path.abspath(take.source.filename) == path:
+        return False
+    swap_source(take, path)
+    refresh_input(var_name, take)
+    build_peaks(take.source)
+    return True
+
+def add_to_cache(key, take):
+    global gc_pending
+    path = os.path.abspath(take.source.filename)
+    if Path(path).is_relative_to(audio_dir):
+        render_cache.add(key, path)
+        gc_pending = True  # may push the cache over its size limit
+
+def take_guid(take):
+    # Unlike take IDs (pointers), GUIDs are saved with the project.
+    guid = take_guids.get(take.id)
+    if guid is None:
+        guid = take_guids[take.id] = reapy.RPR.GetSetMediaItemTakeInfo_String(take.id, "GUID", "", False)[3]
+    return guid
+
+def is_up_to_date(key, take):
+    # Whether, according to the project index, the take still holds what its expression last produced from the same inputs.
+    entry = project_index.get(take_guid(take))
+    if entry is None or entry["key"] != key:
+        return False
+    # Patterns also depend on where the item is.
+    if entry.get("span") is not None and entry["span"] != take_span(take):
+        return False
+    if entry["file"] is None:
+        # The notes may have been edited by hand since.
+        return take.is_midi and entry.get("midi_hash") == midi_hash(take)
+    path = os.path.join(audio_dir, entry["file"])
+    # The file may have been deleted since, in which case the take needs re-rendering.
+    return os.path.abspath(take.source.filename) == path and os.path.exists(path)
+
+def index_take(key, expression, take, positional=None):
+    # `positional`: whether the output was a pattern, which depends on the item's position too (None: as indexed before).
+    guid = take_guid(take)
+    if positional is None:
+        entry = project_index.get(guid)
+        positional = entry is not None and entry.get("span") is not None
+    if take.is_midi:
+        project_index.set(guid, expression, key, span=take_span(take) if positional else None, midi_hash=midi_hash(take))
+        return
+    path = os.path.abspath(take.source.filename)
+    project_index.set(guid, expression, key, path, has_peaks(path), take_span(take) if positional else None)
+
+def validate_index():
+    # Check the index against the project as loaded: forget takes that are gone, adopt renders made by batch_render.py,
+    # and build any peaks that were left unfinished.
+    takes = {take_guid(take): (expression, take) for _, expression, *_, take in snippets.values() if expression is not None}
+    project_index.prune(takes.keys())
+    for guid, (expression, take) in takes.items():
+        entry = project_index.get(guid)
+        if entry is None or entry["file"] is None:
+            continue
+        if (entry["key"] is None and entry["expression"] == expression
+                and os.path.abspath(take.source.filename) == os.path.join(audio_dir, entry["file"])):
+            # Rendered outside REAPER from the project as it was saved, so the render key is that of the inputs as loaded.
+            key = render_key(expression, take)
+            add_to_cache(key, take)
+            index_take(key, expression, take)
+            entry = project_index.get(guid)
+        if entry["peaks"]:
+            continue
+        path = os.path.join(audio_dir, entry["file"])
+        if has_peaks(path):
+            project_index.set(guid, entry["expression"], entry["key"], path, True, entry.get("span"))
+        elif os.path.abspath(take.source.filename) == path:
+            build_peaks(take.source)
+    project_index.save()
+
+# Timings and output sizes of recent evaluations (see profiling.py).
+profiler = profiling.Profiler()
+
+def report_profile():
+    # Show a summary in the console, and save the full records next to the project module.
+    reapy.show_console_message("lambdaw: profile summary\n" + profiler.format_summary())
+    profiler.dump(os.path.join(lambdaw_dir, "profile.json"))
+    profiler.dump(os.path.join(lambdaw_dir, "profile.csv"))
+
+def report_error(message):
+    if project.is_recording:
+        reapy.show_console_message(message)
+    else:
+        reapy.show_message_box(message, "lambdaw expression")
+
+def finish_evaluation(generated_audio):
+    close_inputs()
+    if generated_audio:
+        reapy.update_arrange()
+    render_cache.save()
+    project_index.save()
+
+    reapy.RPR.Undo_OnStateChange2(reapy.Project().id, f"lambdaw: evaluate expressions")
+
+def eval_takes(take_info, use_cache=True):
+    # With `use_cache`, expressions whose inputs haven't changed since an earlier render reuse it instead of re-rendering.
+    # Without it, everything is re-rendered (e.g. to get a new variation of a random expression) and the cache updated.
+    # Inputs may have changed since the last round.
+    namespace.forget_inputs()
+    if evaluator is not None:
+        jobs.extend(Job(info, use_cache) for info in take_info if info[1] is not None)
+        pump_worker()
+        return
 
-def eval_takes(take_info):
-    generated_audio = False
+    generated_audio = evaluated = False
+    profile_target = reapy.get_ext_state("lambdaw", "profile")
     for var_name, expression, track_index, item_index, take in take_info:
         if expression is None:
             continue
+        evaluated = True
+        started = time.perf_counter()
+        record = profiler.start(var_name, expression, take.id)
+        key = render_key(expression, take)
+        if use_cache and is_up_to_date(key, take):
+            cached = False
+        else:
+            cached = use_cached_render(key, var_name, take) if use_cache else None
+        if cached is not None:
+            index_take(key, expression, take)
+            record["cached"] = True
+            profiler.finish(record)
+            generated_audio |= cached
+            check_deadline(take, started)
+            continue
         try:
-            # Add parenthesis to shorten common case of generator expressions.
-            output = eval("(" + expression + ")", namespace)
-        except:
-            if project.is_recording:
-                reapy.show_console_message(traceback.format_exc())
+            if var_name == profile_target:
+                (rebuild_peaks, positional), report = profiling.profiled(evaluate, expression, track_index, item_index, take, record)
+                reapy.show_console_message(f"lambdaw: profile of {var_name}\n{report}")
             else:
-                reapy.show_message_box(traceback.format_exc(), "lambdaw expression")
-        else:      
-            rebuild_peaks = output_converter(output, track_index, item_index, take)
+                rebuild_peaks, positional = evaluate(expression, track_index, item_index, take, record)
+        except:
+            record["error"] = True
+            report_error(traceback.format_exc())
+        else:
             # Update value in namespace immediately.
             # reapy.print(f"EVAL: set {var_name} to {namespace[var_name]}")
-            namespace[var_name] = input_converter(take)
+            refresh_input(var_name, take)
             if rebuild_peaks:
-                build_peaks(take.source)
+                build_peaks(take.source, record)
+                add_to_cache(key, take)
+            index_take(key, expression, take, positional)
             generated_audio |= rebuild_peaks
+            check_deadline(take, started)
+        profiler.finish(record)
 
-    if generated_audio:
-        collect_garbage()
-        reapy.update_arrange()
+    # Without any expressions, there's nothing to save (or undo).
+    if evaluated:
+        finish_evaluation(generated_audio)
 
-    reapy.RPR.Undo_OnStateChange2(reapy.Project().id, f"lambdaw: evaluate expressions")
+def evaluate(expression, track_index, item_index, take, record):
+    # Evaluate an expression and convert its output into the take, recording how long each step took.
+    # Returns whether the take has new audio, and whether the output was a pattern.
+    start = time.perf_counter()
+    # Add parenthesis to shorten common case of generator expressions.
+    output = eval("(" + expression + ")", namespace)
+    record["eval_time"] = time.perf_counter() - start
+    start = time.perf_counter()
+    positional = patterns.is_pattern(output)
+    rebuild_peaks = output_converter(output, track_index, item_index, take)
+    record["convert_time"] = time.perf_counter() - start
+    return rebuild_peaks, positional
 
-# Setup namespace for user code
-namespace = {"sr": SAMPLE_RATE}
+def to_wire(value):
+    # Values sent to the worker must be picklable, so read audio inputs into memory.
+    if isinstance(value, (list, NoteArray)):
+        return value
+    if isinstance(value, AudioInput):
+        return array.array('f', value.view())
+    return array.array('f', value)
 
-lambdaw_dir = os.path.join(reapy.Project().path, "lambdaw")
-audio_dir = os.path.abspath(os.path.join(lambdaw_dir, "audio"))
+class Job:
+    # An expression evaluation handed to the worker pool.
+    def __init__(self, info, use_cache):
+        self.info = info  # (var_name, expression, track_index, item_index, take)
+        self.use_cache = use_cache
+        self.key = None
+        self.worker = None
+        self.request_id = None
+        self.path = None
+        self.reply = None
+        self.started = time.perf_counter()
 
-# Make directory for generated audio clips
-os.makedirs(audio_dir, exist_ok=True)
-os.chdir(lambdaw_dir)
+# Pending evaluations, in dependency order. Results are applied strictly in this order, whichever worker finishes first.
+jobs = collections.deque()
 
-module_path = Path("project.py")
-if not module_path.exists():
-    module_path.touch()
+def dispatch_jobs():
+    # Hand queued jobs to idle workers. A job can start once every job before it that it depends on has been applied;
+    # this way, independent expressions run concurrently while dependent ones still see up-to-date inputs.
+    busy = {job.worker for job in jobs if job.worker is not None and job.reply is None}
+    idle = [worker for worker in evaluator.workers if worker not in busy]
+    hits = False
+    blocked = set()  # variables that will change once earlier jobs are applied
+    profile_target = reapy.get_ext_state("lambdaw", "profile")
+    for job in jobs:
+        var_name, expression, track_index, item_index, take = job.info
+        if job.worker is None and job.reply is None and not (deps.free_names(expression) & blocked):
+            try:
+                job.key = render_key(expression, take)
+                if job.use_cache and (is_up_to_date(job.key, take) or render_cache.get(job.key) is not None):
+                    job.reply = ("cached",)
+                    hits = True
+                    blocked.add(var_name)
+                    continue
+                if not idle:
+                    break
+                bindings = {}
+                for name in deps.free_names(expression) & definitions.keys():
+                    bindings[name] = to_wire(namespace[name])
+            except:
+                job.reply = ("error", None, traceback.format_exc())
+            else:
+                bindings["sr"] = sample_rate
+                target = worker.Target(new_audio_path(track_index, item_index), int(take.item.length * sample_rate),
+                                       sample_rate, sample_format, (take.item.position, take.item.length, CYCLE_LENGTH),
+                                       time_limit)
+                target.profile = var_name == profile_target
+                job.path = target.path
+                job.worker = idle.pop(0)
+                job.request_id = job.worker.submit(expression, bindings, (track_index, item_index, target))
+        blocked.add(var_name)
+    return hits
 
-# Load user project module by path.
-# See https://docs.python.org/3/library/importlib.html#importing-a-source-file-directly
-# We need to do it this way instead of just modifying sys.path in order to
-# deal with having multiple "project" modules - one per Reaper project.
-spec = importlib.util.spec_from_file_location("project", module_path)
-user_project_module = importlib.util.module_from_spec(spec)
-sys.modules["project"] = user_project_module
-spec.loader.exec_module(user_project_module)
-exec("from project import *", namespace)
+def apply_jobs():
+    # Apply finished jobs at the front of the queue, on the main thread. Returns (any applied, any audio generated).
+    applied = generated_audio = False
+    while jobs and jobs[0].reply is not None:
+        job = jobs.popleft()
+        var_name, expression, track_index, item_index, take = job.info
+        applied = True
+        if not reapy.RPR.ValidatePtr2(project.id, take.id, "MediaItem_Take*"):
+            continue  # deleted while it was being evaluated
+        record = profiler.start(var_name, expression, take.id)
+        if job.reply[0] == "cached":
+            record["cached"] = True
+            generated_audio |= bool(use_cached_render(job.key, var_name, take))
+            index_take(job.key, expression, take)
+        elif job.reply[0] == "error":
+            record["error"] = True
+            report_error(job.reply[2])
+        else:
+            result = job.reply[2]
+            # Timings measured by the worker.
+            record["eval_time"] = result.get("eval_time", 0)
+            record["convert_time"] = result.get("convert_time", 0)
+            if "profile" in result:
+                reapy.show_console_message(f"lambdaw: profile of {var_name}\n{result['profile']}")
+            rebuild_peaks = apply_result(result, take)
+            refresh_input(var_name, take)
+            if rebuild_peaks:
+                build_peaks(take.source, record)
+                add_to_cache(job.key, take)
+            index_take(job.key, expression, take, result.get("positional", False))
+            generated_audio |= rebuild_peaks
+        profiler.finish(record)
+        check_deadline(take, job.started)
+    return applied, generated_audio
 
-def scan_items():
+def pump_worker():
+    # Collect results from the worker pool, apply them, and start whatever can run next. Never blocks.
+    if evaluator is None:
+        return
+    for w in list(evaluator.workers):
+        try:
+            messages = w.poll()
+        except (EOFError, OSError):
+            report_error("lambdaw worker exited unexpectedly; restarting it.")
+            for job in jobs:
+                if job.worker is w and job.reply is None:
+                    job.reply = ("error", job.request_id, "lambdaw worker exited while evaluating " + job.info[1])
+            evaluator.restart(w)
+            continue
+        for message in messages:
+            if message[0] == "loaded":
+                if message[1] is not None:
+                    report_error(message[1])
+                continue
+            for job in jobs:
+                if job.worker is w and job.request_id == message[1]:
+                    job.reply = message
+                    break
+
+    applied = generated_audio = False
+    while True:
+        hits = dispatch_jobs()
+        newly_applied, audio = apply_jobs()
+        applied |= newly_applied
+        generated_audio |= audio
+        if not (hits or newly_applied):
+            break
+    if applied:
+        finish_evaluation(generated_audio)
+
+def cancel_jobs():
+    # Drop all pending evaluations, killing the workers that are in the middle of one.
+    # Takes being rendered keep their previous source, since nothing is swapped in until a render completes.
+    if evaluator is None:
+        return
+    for job in jobs:
+        if job.worker is not None and job.reply is None:
+            evaluator.restart(job.worker, kill=True)
+            try:
+                os.unlink(job.path + ".part")
+            except OSError:
+                pass
+        cycle_deadlines.pop(job.info[-1].id, None)
+    jobs.clear()
+
+def midi_hash(take):
+    # Changes whenever a MIDI take's events do.
+    return reapy.RPR.MIDI_GetHash(take.id, False, "", 64)[3]
+
+def take_state(take):
+    # Cheap summary of a take's contents, which changes whenever its converted value would.
+    state = (reapy.RPR.GetMediaItemTake_Source(take.id), take.item.position, take.item.length, take.start_offset)
+    if take.is_midi:
+        state += (midi_hash(take),)
+    else:
+        state += take_processing(take)
+    return state
+
+class LazyInput:
+    # A take's value in the namespace, converted only when an expression looks it up,
+    # and then memoized until the take changes.
+    def __init__(self, take):
+        self.take = take
+        self.state = None
+        self.value = None
+
+    def get(self):
+        state = take_state(self.take)
+        if state != self.state:
+            self.value = input_converter(self.take)
+            self.state = state
+        return self.value
+
+# Builtins are copied into the namespace, so that looking them up doesn't go through `Namespace.__missing__`.
+BUILTINS = {name: value for name, value in vars(builtins).items() if not name.startswith("_")}
+
+class Namespace(dict):
+    # Globals for expressions. Item variables are looked up in `inputs` (var_name -> LazyInput)
+    # when they aren't found in the dict itself, so only the items an expression uses are ever converted.
+    # Converted values are kept in the dict until `forget_inputs` (at the next scan or round of evaluation),
+    # so each take is only checked for changes once per round.
+    def __init__(self, *args, **kwargs):
+        super().__init__(BUILTINS)
+        self.update(*args, **kwargs)
+        self.inputs = {}
+
+    def __missing__(self, name):
+        if name in self.inputs:
+            value = self[name] = self.inputs[name].get()
+            return value
+        raise KeyError(name)
+
+    def forget_inputs(self):
+        for name in self.inputs:
+            self.pop(name, None)
+
+    def uncover(self, name):
+        # Remove a name, making the builtin it shadowed (if any) visible again.
+        self.pop(name, None)
+        if name in BUILTINS:
+            self[name] = BUILTINS[name]
+
+# take ID -> LazyInput, kept across scans so that memoized values survive.
+lazy_inputs = {}
+
+def update_inputs(exclude=()):
+    global lazy_inputs
+    lazy_inputs = {id: lazy_inputs.get(id) or LazyInput(take) for id, (*_, take) in snippets.items()}
+    namespace.forget_inputs()
+    previous, namespace.inputs = namespace.inputs, {}
+    # If several items share a name, the last one wins (and is the only one that gets converted).
+    for id, (var_name, *_) in snippets.items():
+        if id not in exclude:
+            # Item variables take precedence over names from the project module.
+            namespace.pop(var_name, None)
+            namespace.inputs[var_name] = lazy_inputs[id]
+    for var_name in previous.keys() - namespace.inputs.keys():
+        namespace.uncover(var_name)
+
+def refresh_input(var_name, take):
+    # Called after a take has been (re-)rendered, so that later expressions see its new value.
+    lazy_inputs[take.id] = namespace.inputs[var_name] = LazyInput(take)
+    namespace.pop(var_name, None)
+
+# Python interpreter used to run evaluation workers.
+WORKER_PYTHON = "python"
+# Number of worker processes evaluating expressions in parallel. Can be overridden with the "worker_count" ext state.
+WORKER_COUNT = max(1, min(4, (os.cpu_count() or 2) // 2))
+
+def read_settings(project):
+    # Settings that only take effect on a full `load()`: worker mode, worker count, sample rate, sample format, and time limit.
+    return (reapy.get_ext_state("lambdaw", "worker") == "1", reapy.get_ext_state("lambdaw", "worker_count"),
+            project_sample_rate(project), project.get_ext_state("lambdaw", "sample_format"),
+            project.get_ext_state("lambdaw", "time_limit"))
+
+def settings_changed():
+    # Whether a reload has to go through `load()` to apply changed settings (e.g. from toggle_worker.py).
+    return read_settings(reapy.Project()) != settings
+
+def project_sample_rate(project):
+    # The project's sample rate if it sets one, otherwise the audio device's.
+    if reapy.RPR.GetSetProjectInfo(project.id, "PROJECT_SRATE_USE", 0, False):
+        return int(reapy.RPR.GetSetProjectInfo(project.id, "PROJECT_SRATE", 0, False))
+    ok, _, rate, _ = reapy.RPR.GetAudioDeviceInfo("SRATE", "", 64)
+    return int(rate) if ok and rate.isdigit() else render.SAMPLE_RATE
+
+# (mtime, size) of project.py when it was last loaded, and the names it exported into the namespace.
+module_stamp = None
+module_version = None
+project_names = set()
+user_project_module = None
+
+def load_project_module(force=False):
+    # (Re-)execute the user's project module if it has changed since it was last loaded, and patch its new definitions
+    # into the existing namespace. Returns whether it was (re-)executed.
+    global module_stamp, module_version, project_names, user_project_module, input_converter, output_converter
+    stat = module_path.stat()
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    if stamp == module_stamp and not force:
+        return False
+    module_stamp = stamp
+    # Renders made with a different version of the project module can't be reused.
+    version = cache.fingerprint(module_path.read_bytes())
+    if version == module_version and not force:
+        return False
+    previous_version, module_version = module_version, version
+    # Memoized results (see memo.py) from the previous version are stale.
+    memo.configure(os.path.join(lambdaw_dir, "memo"), version)
+    if previous_version != version:
+        memo.invalidate(previous_version)
+
+    if evaluator is not None:
+        evaluator.load(os.path.abspath(module_path), sample_rate)
+        return True
+
+    # Load user project module by path.
+    # See https://docs.python.org/3/library/importlib.html#importing-a-source-file-directly
+    # We need to do it this way instead of just modifying sys.path in order to
+    # deal with having multiple "project" modules - one per Reaper project.
+    # The module may register its own converters again.
+    input_converter, output_converter = convert_input, convert_output
+    spec = importlib.util.spec_from_file_location("project", module_path)
+    user_project_module = importlib.util.module_from_spec(spec)
+    sys.modules["project"] = user_project_module
+    spec.loader.exec_module(user_project_module)
+    exported = getattr(user_project_module, "__all__", None)
+    if exported is None:
+        exported = [name for name in vars(user_project_module) if not name.startswith("_")]
+    for name in project_names.difference(exported):
+        namespace.uncover(name)
+    exec("from project import *", namespace)
+    project_names = set(exported)
+    # Item variables take precedence over names from the project module.
+    for var_name in namespace.inputs:
+        namespace.pop(var_name, None)
+    # Values converted by the previous module's input converter may be stale.
+    for lazy_input in lazy_inputs.values():
+        lazy_input.state = None
+    return True
+
+# Change detection. REAPER bumps the project state change count on every edit (and undo/redo),
+# so as long as it stays put, the previous scan is still accurate and the project needn't be walked at all.
+last_change_count = None
+# track pointer -> (track_index, [(take pointer, take name, position)], [(take ID, snippet)]) as of the last scan
+scanned_tracks = {}
+# take ID -> (var_name, expression, position)
+take_index = {}
+
+def read_track(track_id):
+    # Direct API calls, avoiding the overhead of building reapy objects for every item.
+    entries = []
+    for item_index in range(reapy.RPR.CountTrackMediaItems(track_id)):
+        item_id = reapy.RPR.GetTrackMediaItem(track_id, item_index)
+        take_id = reapy.RPR.GetActiveTake(item_id)
+        if not reapy.RPR.ValidatePtr(take_id, "MediaItem_Take*"):
+            entries.append(None)  # empty item
+            continue
+        entries.append((take_id, reapy.RPR.GetTakeName(take_id), reapy.RPR.GetMediaItemInfo_Value(item_id, "D_POSITION")))
+    return entries
+
+def scan_items(force=False):
     # NOTE: Even if we're only re-evaluating a subset of items,
     # the namespace needs to contain all items so user code can refer to them.
-    snippets = {}
-    for track_index, track in enumerate(reapy.Project().tracks):
-        for item_index, item in enumerate(track.items):
-            take = item.active_take
-            var_name, *expression = take.name.split("=", 1)
+    global last_change_count, scanned_tracks
+    project_id = reapy.Project().id
+    change_count = reapy.RPR.GetProjectStateChangeCount(project_id)
+    if change_count == last_change_count and not force:
+        return snippets
+    last_change_count = change_count
+    snippets_by_track = {}
+    for track_index in range(reapy.RPR.CountTracks(project_id)):
+        track_id = reapy.RPR.GetTrack(project_id, track_index)
+        entries = read_track(track_id)
+        previous = scanned_tracks.get(track_id)
+        if previous is not None and previous[:2] == (track_index, entries):
+            # Unchanged track: reuse its snippets.
+            snippets_by_track[track_id] = previous
+            continue
+        track_snippets = []
+        for item_index, entry in enumerate(entries):
+            if entry is None:
+                continue
+            take_id, name, position = entry
+            take = reapy.Take(take_id)
+            var_name, *expression = name.split("=", 1)
             expression = expression[0] if expression else None
             # Expression item: may need evaluation
-            snippets[take.id] = (var_name, expression, track_index, item_index, take)
+            track_snippets.append((take.id, (var_name, expression, track_index, item_index, take)))
+            take_index[take.id] = (var_name, expression, position)
             # reapy.print(f"SCAN: set {var_name} to {namespace[var_name]}")
-    return snippets
-
-snippets = scan_items()
-project = reapy.Project()
-
-counter = 0
+        snippets_by_track[track_id] = (track_index, entries, track_snippets)
+    scanned_tracks = snippets_by_track
+    result = {id: snippet for _, _, track_snippets in scanned_tracks.values() for id, snippet in track_snippets}
+    for id in take_index.keys() - result.keys():
+        del take_index[id]
+        if not reapy.RPR.ValidatePtr2(project_id, id, "MediaItem_Take*"):
+            release_file(id)  # deleted
+    return result
 
-CYCLE_LENGTH = project.time_signature[1] / project.time_signature[0] * 60  # seconds
+def get_definitions(snippets):
+    # Variable name -> take whose value it holds (the last one, if several items share a name).
+    return {var_name: take for var_name, expression, track_index, item_index, take in snippets.values()}
 
-# track -> take
+# Livecoding mode: while recording, tracks named with an expression get a new item for each upcoming cycle,
+# which is rendered as soon as it's created, ahead of the play position.
+# track ID -> {cycle index: take} for items whose cycle hasn't started yet
 next_cycle_items = {}
+# How many cycles ahead to render, at most. Tracks whose renders take longer than a cycle get more look-ahead.
+MAX_LOOKAHEAD_CYCLES = 2
+# track ID -> recent render time in seconds, used to pick the look-ahead
+render_estimates = {}
+# take ID -> (track ID, cycle start time) for pre-rendered items that haven't landed yet
+cycle_deadlines = {}
 
 def is_expression_name(name):
     before, *after = name.split("=", 1)
     return after and (before == "" or before.isidentifier())
 
-def execute(pending):
-    global counter, snippets, project, next_cycle_items
-    if not (pending or counter > 3):
-        # Don't check for updates every time.
-        counter += 1
+def schedule_cycles():
+    # Create (and name) items for upcoming cycles on expression tracks.
+    # Returns the take info for items that need to be rendered now: new ones, and ones whose track expression changed.
+    global next_cycle_items
+    if not project.is_recording:
+        if next_cycle_items:
+            for takes in next_cycle_items.values():
+                for take in takes.values():
+                    take.item.delete()
+            next_cycle_items = {}
+            cycle_deadlines.clear()
+            reapy.update_arrange()
+        return []
+    play_position = project.play_position
+    current_cycle = int(play_position // CYCLE_LENGTH)
+    to_render = []
+    for track_index, track in enumerate(project.tracks):
+        if not is_expression_name(track.name):
+            continue
+        pending = next_cycle_items.setdefault(track.id, {})
+        for cycle in [cycle for cycle in pending if cycle <= current_cycle]:
+            # Now playing, so no longer pending.
+            pending.pop(cycle).item.set_info_value("C_LOCK", 0)
+        for cycle, take in pending.items():
+            if take.name != track.name:
+                reapy.RPR.GetSetMediaItemTakeInfo_String(take.id, "P_NAME", track.name, True)
+                to_render.append((track_index, track, cycle, take))
+        # Time budget: if rendering this track takes longer than the time left before the next cycle, start earlier.
+        estimate = render_estimates.get(track.id, 0)
+        budget = (current_cycle + 1) * CYCLE_LENGTH - play_position
+        lookahead = min(MAX_LOOKAHEAD_CYCLES, 1 + math.ceil(max(estimate - budget, 0) / CYCLE_LENGTH))
+        for cycle in range(current_cycle + 1, current_cycle + 1 + lookahead):
+            if cycle in pending:
+                continue
+            cycle_start = cycle * CYCLE_LENGTH
+            cycle_end = cycle_start + CYCLE_LENGTH
+            for item in track.items:
+                if item.position < cycle_end and item.position + item.length > cycle_start:
+                    break  # found an item there already
+            else:
+                item = track.add_item(cycle_start, cycle_end)
+                # Visually indicate that the cycle is pending using item lock
+                item.set_info_value("C_LOCK", 1)
+                take = item.add_take()
+                reapy.RPR.GetSetMediaItemTakeInfo_String(take.id, "P_NAME", track.name, True)
+                pending[cycle] = take
+                to_render.append((track_index, track, cycle, take))
+    snippets = []
+    for track_index, track, cycle, take in to_render:
+        var_name, expression = track.name.split("=", 1)
+        item_index = int(take.item.get_info_value("IP_ITEMNUMBER"))
+        snippets.append((take.id, (var_name, expression, track_index, item_index, take)))
+        cycle_deadlines[take.id] = (track.id, cycle * CYCLE_LENGTH)
+    return snippets
+
+def check_deadline(take, started):
+    # Called once a pre-rendered cycle has landed in the timeline: update the track's estimate and report if it was late.
+    deadline = cycle_deadlines.pop(take.id, None)
+    if deadline is None:
         return
-    counter = 0
+    track_id, cycle_start = deadline
+    elapsed = time.perf_counter() - started
+    previous = render_estimates.get(track_id)
+    render_estimates[track_id] = elapsed if previous is None else (previous + elapsed) / 2
+    late = project.play_position - cycle_start
+    if project.is_playing and late > 0:
+        reapy.show_console_message(f"lambdaw: cycle at {cycle_start:.2f}s landed {late:.3f}s late (render took {elapsed:.3f}s)\n")
 
-    # Check for expressions in track names (livecoding mode)
-    # TODO: Extract to separate function
+def execute(pending):
+    # Returns whether anything happened or is still in progress (session.py polls more often while it is).
+    global snippets, definitions, project
+    # These commands don't evaluate anything, so once handled, the rest is a regular tick.
+    if pending == "cancel":
+        cancel_jobs()
+        pending = ""
+    elif pending == "profile_report":
+        report_profile()
+        pending = ""
+    pump_worker()
+    advance_peaks()
+    if not (jobs or peak_jobs):
+        collect_garbage()
+
+    # Livecoding mode: render upcoming cycles right away, rather than waiting for the next scan to notice them.
+    cycle_snippets = schedule_cycles()
     new_cycle_items = set()
-    if project.is_recording:
-        for track in project.tracks:
-            if is_expression_name(track.name):
-                if track.id in next_cycle_items and next_cycle_items[track.id].name != track.name:
-                    take = next_cycle_items[track.id]
-                    reapy.RPR.GetSetMediaItemTakeInfo_String(take.id, "P_NAME", track.name, True)
-                    next_cycle_items[track.id] = take
-                next_cycle_start = (project.play_position // CYCLE_LENGTH + 1) * CYCLE_LENGTH
-                next_cycle_end = next_cycle_start + CYCLE_LENGTH
-                for item in track.items:
-                    if item.position < next_cycle_end and item.position + item.length > next_cycle_start:
-                        break  # found an item there already
-                else:
-                    item = track.add_item(next_cycle_start, next_cycle_end)
-                    # Visually indicate that next cycle is pending using item lock
-                    item.set_info_value("C_LOCK", 1)
-                    take = item.add_take()
-                    reapy.RPR.GetSetMediaItemTakeInfo_String(take.id, "P_NAME", track.name, True)
-                    old_take = next_cycle_items.get(track.id, None)
-                    if old_take:
-                        old_take.item.set_info_value("C_LOCK", 0)
-                    next_cycle_items[track.id] = take
-                    new_cycle_items.add(take.id)
-    else:
-        for take in next_cycle_items.values():
-            take.item.delete()
-        next_cycle_items = {}
-        reapy.update_arrange()
+    if cycle_snippets:
+        eval_takes(snippet for _, snippet in cycle_snippets)
+        # Record them as already evaluated, so the next scan doesn't evaluate them again.
+        snippets = {**snippets, **dict(cycle_snippets)}
+        if evaluator is not None:
+            # Not rendered yet, so still empty; don't let them shadow the previous cycle's value.
+            new_cycle_items = {id for id, _ in cycle_snippets}
+
+    busy = bool(jobs or peak_jobs or cycle_snippets)
 
     old_snippets = snippets
-    snippets = scan_items()
-    # TODO: Only convert *last* copy with name.
-    for id, (var_name, expression, track_index, item_index, take) in snippets.items():
-        # Avoid reading in items newly-generated from tracks, which are empty.
-        if id not in new_cycle_items:
-            namespace[var_name] = input_converter(take)
+    start = time.perf_counter()
+    snippets = scan_items(force=bool(pending or cycle_snippets))
+    if snippets is not old_snippets:
+        profiler.scan(time.perf_counter() - start, len(snippets))
+    if snippets is old_snippets and not pending:
+        return busy  # nothing changed since the last scan
+    definitions = get_definitions(snippets)
+    # Avoid reading in items newly-generated from tracks, which are empty.
+    update_inputs(exclude=new_cycle_items)
 
     changed = set()
     for key, value in snippets.items():
@@ -279,9 +1159,115 @@ def execute(pending):
     # reapy.print("TICK")
     if changed or pending:
         # reapy.print("changed:", {id: snippets[id][0] for id in changed})
-        filter = {
-            "eval_all": lambda _: True,
-            "eval_selected": lambda take: take.item.is_selected or take.id in changed,
-            "": lambda take: take.id in changed,
-        }[pending]
-        eval_takes(v for v in snippets.values() if filter(v[-1]))
+        if pending == "eval_all":
+            roots = snippets.keys()
+        elif pending == "eval_selected":
+            roots = changed | {id for id, snippet in snippets.items() if snippet[-1].item.is_selected}
+        else:
+            roots = changed
+        # Re-evaluate everything downstream of the changed items, upstream first.
+        order, cyclic = deps.DependencyGraph(snippets).evaluation_order(roots)
+        if cyclic:
+            report_error(f"lambdaw: circular dependency between {', '.join(sorted(cyclic))}; skipping these expressions.")
+        # Explicitly re-evaluating selected items always re-renders them.
+        eval_takes((snippets[id] for id in order), use_cache=pending != "eval_selected")
+    return True
+
+# Globals that belong to the current REAPER project.
+# session.py keeps a copy of them for each open project (see `save_state`), so switching tabs doesn't require a reload.
+PROJECT_STATE = [
+    "namespace", "lambdaw_dir", "audio_dir", "module_path", "module_stamp", "module_version", "project_names",
+    "user_project_module", "input_converter", "output_converter", "render_cache", "project_index", "take_guids", "evaluator", "jobs",
+    "file_users", "take_files", "unused_files", "gc_pending", "last_change_count", "scanned_tracks", "take_index", "snippets", "definitions", "lazy_inputs",
+    "project", "settings", "sample_rate", "SAMPLE_RATE", "sample_format", "time_limit", "CYCLE_LENGTH", "next_cycle_items", "render_estimates", "cycle_deadlines",
+]
+
+def save_state():
+    return {name: globals()[name] for name in PROJECT_STATE}
+
+def restore_state(state):
+    globals().update(state)
+    os.chdir(lambdaw_dir)
+    memo.configure(os.path.join(lambdaw_dir, "memo"), module_version)
+    if user_project_module is not None:
+        sys.modules["project"] = user_project_module
+
+def load():
+    # Set up lambdaw for the current project. Returns the time taken by each phase, in seconds.
+    global namespace, lambdaw_dir, audio_dir, module_path, module_stamp, module_version, project_names
+    global user_project_module, input_converter, output_converter, render_cache, project_index, take_guids, evaluator, jobs
+    global file_users, take_files, unused_files, gc_pending
+    global last_change_count, scanned_tracks, take_index, snippets, definitions, lazy_inputs
+    global project, settings, sample_rate, SAMPLE_RATE, sample_format, time_limit, CYCLE_LENGTH, next_cycle_items, render_estimates, cycle_deadlines
+    timings = {}
+    start = time.perf_counter()
+    project = reapy.Project()
+    CYCLE_LENGTH = project.time_signature[1] / project.time_signature[0] * 60  # seconds
+    next_cycle_items, render_estimates, cycle_deadlines = {}, {}, {}
+    settings = read_settings(project)
+    use_worker, worker_count, sample_rate, sample_format, time_limit = settings
+    # Project modules read the sample rate as `lambdaw.SAMPLE_RATE`.
+    SAMPLE_RATE = sample_rate
+    # Format of rendered audio: "int16" (default), "int24", or "float32". Set per project with the "lambdaw"/"sample_format"
+    # project ext state.
+    if sample_format not in render.SAMPLE_FORMATS:
+        sample_format = "int16"
+    # Longest a single render may take, in seconds. Set per project with the "lambdaw"/"time_limit" project ext state;
+    # otherwise, `render.TIME_LIMIT` applies.
+    time_limit = render.parse_time_limit(time_limit)
+
+    # Setup namespace for user code
+    namespace = Namespace({"sr": sample_rate})
+    lazy_inputs = {}
+    jobs = collections.deque()
+
+    lambdaw_dir = os.path.join(project.path, "lambdaw")
+    audio_dir = os.path.abspath(os.path.join(lambdaw_dir, "audio"))
+
+    # Make directory for generated audio clips
+    os.makedirs(audio_dir, exist_ok=True)
+    os.chdir(lambdaw_dir)
+
+    module_path = Path("project.py")
+    if not module_path.exists():
+        module_path.touch()
+    render_cache = cache.RenderCache(audio_dir)
+    project_index = cache.ProjectIndex(lambdaw_dir)
+    take_guids = {}
+    timings["setup"] = time.perf_counter() - start
+
+    # If enabled (see toggle_worker.py), the project module is loaded in worker processes instead (see worker.py).
+    start = time.perf_counter()
+    if use_worker:
+        evaluator = worker.get_pool(lambdaw_dir, int(worker_count) if worker_count.isdigit() else WORKER_COUNT, WORKER_PYTHON)
+        timings["workers"] = time.perf_counter() - start
+        start = time.perf_counter()
+    else:
+        evaluator = None
+        # Worker mode was switched off: stop the project's workers.
+        pool = worker.pools.pop(lambdaw_dir, None)
+        if pool is not None:
+            pool.close()
+    module_stamp = module_version = user_project_module = None
+    project_names = set()
+    load_project_module(force=True)
+    timings["project module"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    last_change_count, scanned_tracks, take_index = None, {}, {}
+    snippets = {}
+    snippets = scan_items()
+    definitions = get_definitions(snippets)
+    update_inputs()
+    timings["scan"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reconcile_files()
+    timings["gc"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    validate_index()
+    timings["index"] = time.perf_counter() - start
+    return timings
+
+load_timings = load()
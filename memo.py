@@ -0,0 +1,209 @@
+# Memoization of expensive helper calls in project modules (model inference, speech synthesis, etc.):
+#
+#     @lambdaw.memoize
+#     def rave(audio, model): ...
+#
+# Results are keyed by the function, a fingerprint of its arguments (including audio and MIDI inputs),
+# and the version of the project module, so editing the module invalidates them.
+# They're kept in memory, and (if they can be pickled) on disk in lambdaw/memo/, so they also survive restarts.
+# Both tiers are bounded in size, evicting the least recently used results first.
+# On disk, each result is a file of its own, in a subdirectory for the project module version, and the file's modification
+# time records when it was last used. There's no shared index to keep consistent, so lambdaw and its workers (which
+# share the directory) see each other's results as soon as they're stored.
+# This module doesn't depend on reapy, so it works the same in worker processes (see worker.py).
+import collections
+import functools
+import hashlib
+import os
+import pickle
+import shutil
+import sys
+
+import render
+
+MAX_MEMORY_BYTES = 256 * 1024**2
+MAX_DISK_BYTES = 2 * 1024**3
+
+directory = None  # disk tier location; None disables it
+version = None  # project module version
+memory = collections.OrderedDict()  # key -> (version, size, value), in least-recently-used order
+memory_size = 0
+
+class Unmemoizable(Exception):
+    pass
+
+def configure(new_directory, new_version):
+    # Called whenever the project module is (re)loaded, or another project becomes current.
+    global directory, version
+    version = new_version
+    if new_directory == directory:
+        return
+    directory = new_directory
+    if directory is None:
+        return
+    os.makedirs(directory, exist_ok=True)
+    invalidate()
+
+def version_directory():
+    return os.path.join(directory, str(version))
+
+def entry_path(key):
+    return os.path.join(version_directory(), key + ".pickle")
+
+def invalidate(old_version=None):
+    # Drop results computed with other versions of the project module: on disk, everything not from the current version
+    # (the directory belongs to one project), and in memory (which is shared by all open projects), those from `old_version`.
+    global memory_size
+    if old_version is not None:
+        for key, (entry_version, size, _) in list(memory.items()):
+            if entry_version == old_version:
+                del memory[key]
+                memory_size -= size
+    if directory is not None:
+        for name in os.listdir(directory):
+            if name == str(version):
+                continue
+            path = os.path.join(directory, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                remove_path(path)
+
+def feed(digest, value):
+    # Add a fingerprint of `value` to `digest`, based on its contents.
+    if value is None or isinstance(value, (bool, int, float, complex, str)):
+        digest.update(repr((type(value).__name__, value)).encode("utf8"))
+    elif isinstance(value, (bytes, bytearray)):
+        digest.update(b"bytes%d:" % len(value))
+        digest.update(value)
+    elif hasattr(value, "memo_key"):
+        # Objects that stand for external data (e.g. `lambdaw.AudioInput`) identify it themselves.
+        feed(digest, value.memo_key())
+    elif isinstance(value, (list, tuple)):
+        digest.update(b"%s%d:" % (type(value).__name__.encode("utf8"), len(value)))
+        for item in value:
+            feed(digest, item)
+    elif isinstance(value, dict):
+        digest.update(b"dict%d:" % len(value))
+        for key, item in sorted(value.items(), key=lambda pair: repr(pair[0])):
+            feed(digest, key)
+            feed(digest, item)
+    elif (buffer := render.as_buffer(value)) is not None:
+        digest.update(f"buffer{buffer.format}{len(buffer)}:".encode("utf8"))
+        digest.update(buffer.cast("B"))
+    elif iter(value) is value if hasattr(value, "__iter__") else False:
+        raise Unmemoizable("iterators can only be read once")
+    else:
+        try:
+            digest.update(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        except Exception as e:
+            raise Unmemoizable(str(e))
+
+def make_key(fn, args, kwargs):
+    digest = hashlib.blake2b(digest_size=16)
+    feed(digest, (version, fn.__module__, fn.__qualname__, args, kwargs))
+    return digest.hexdigest()
+
+def lookup(key, disk):
+    if key in memory:
+        memory.move_to_end(key)
+        return True, memory[key][2]
+    if disk and directory is not None:
+        path = entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return False, None
+        except Exception:
+            remove_path(path)
+            return False, None
+        try:
+            os.utime(path)  # mark as recently used
+        except OSError:
+            pass
+        remember(key, value, size)
+        return True, value
+    return False, None
+
+def store(key, value, disk):
+    try:
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        data = None
+    buffer = render.as_buffer(value)
+    size = buffer.nbytes if buffer is not None else len(data) if data is not None else sys.getsizeof(value)
+    remember(key, value, size)
+    if disk and directory is not None and data is not None and len(data) <= MAX_DISK_BYTES:
+        path = entry_path(key)
+        # Temporary files are per process, since other processes may be storing the same result.
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(version_directory(), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            # e.g. another process has since loaded a new version of the project module, and deleted this one's results.
+            remove_path(tmp_path)
+            return
+        evict()
+
+def remember(key, value, size):
+    global memory_size
+    if size > MAX_MEMORY_BYTES:
+        return
+    memory[key] = (version, size, value)
+    memory_size += size
+    while memory_size > MAX_MEMORY_BYTES:
+        _, (_, old_size, _) = memory.popitem(last=False)
+        memory_size -= old_size
+
+def evict():
+    # Delete the least recently used results on disk beyond the size limit.
+    entries = []
+    try:
+        with os.scandir(version_directory()) as it:
+            for entry in it:
+                if entry.name.endswith(".pickle"):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue  # deleted by another process meanwhile
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except OSError:
+        return
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= MAX_DISK_BYTES:
+            break
+        total -= size
+        remove_path(path)
+
+def remove_path(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+def memoize(fn=None, *, disk=True):
+    # Decorator; use as `@memoize`, or `@memoize(disk=False)` for results that shouldn't be stored on disk.
+    # Memoized functions return the same object for the same arguments, so callers shouldn't modify results.
+    # Calls with arguments that can't be fingerprinted (such as generators) aren't memoized.
+    if fn is None:
+        return functools.partial(memoize, disk=disk)
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            key = make_key(fn, args, kwargs)
+        except Unmemoizable:
+            return fn(*args, **kwargs)
+        found, value = lookup(key, disk)
+        if not found:
+            value = fn(*args, **kwargs)
+            if not (hasattr(value, "__next__") and iter(value) is value):
+                store(key, value, disk)
+        return value
+    wrapper.uncached = fn
+    return wrapper
@@ -1,23 +1,33 @@
+# MusicVAE sampling, as a model server script (see models.py) or from the command line.
 import sys
 
 from magenta.models.music_vae import configs
 from magenta.models.music_vae import TrainedModel
 
-model = sys.argv[1]
-config = configs.CONFIG_MAP[model]
-checkpoint_dir_or_path = f"{model}.tar"
-temperature = 0.5
+def load(model):
+    config = configs.CONFIG_MAP[model]
+    return config, TrainedModel(config, batch_size=4, checkpoint_dir_or_path=f"{model}.tar")
 
-model = TrainedModel(
-    config, batch_size=1,
-    checkpoint_dir_or_path=checkpoint_dir_or_path)
+def to_notes(sequence):
+    return [
+        {"pitch": note.pitch, "velocity": note.velocity, "start": note.start_time, "end": note.end_time}
+        for note in sequence.notes
+    ]
 
-results = model.sample(
-    n=1,
-    length=config.hparams.max_seq_len,
-    temperature=temperature)
+def run(model, temperature=0.5):
+    return run_batch(model, [((), {"temperature": temperature})])[0]
 
-print([
-    {"pitch": note.pitch, "velocity": note.velocity, "start": note.start_time, "end": note.end_time}
-    for note in results[0].notes
-])
+def run_batch(model, requests):
+    # Sample all the requests with the same temperature at once.
+    config, trained_model = model
+    temperatures = [kwargs.get("temperature", args[0] if args else 0.5) for args, kwargs in requests]
+    samples = {}
+    for temperature in set(temperatures):
+        samples[temperature] = iter(trained_model.sample(
+            n=temperatures.count(temperature),
+            length=config.hparams.max_seq_len,
+            temperature=temperature))
+    return [to_notes(next(samples[temperature])) for temperature in temperatures]
+
+if __name__ == "__main__":
+    print(run(load(sys.argv[1])))
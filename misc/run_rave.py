@@ -1,27 +1,49 @@
+# RAVE (https://github.com/acids-ircam/RAVE), as a model server script (see models.py) or from the command line.
 import sys
 import wave
 
 import torch
-import torchaudio
 
-if len(sys.argv) < 3:
-    print(f"usage: {sys.argv[0]} <model path> <input path> <output path>")
-    exit()
+delay = 29100
 
-model = torch.jit.load(sys.argv[1])
+def load(model_path):
+    return torch.jit.load(model_path)
 
-audio, sr = torchaudio.load(sys.argv[2])
+def as_tensor(audio):
+    # Mono audio, as a buffer of floats or doubles.
+    return torch.frombuffer(audio, dtype=torch.float64 if audio.format == "d" else torch.float32).float()
 
-delay = 29100
+def process(model, batch):
+    # `batch`: (clips, samples) -> (clips, samples, channels)
+    batch = torch.concatenate((batch, torch.zeros(batch.shape[0], delay)), axis=1).unsqueeze(1)
+    with torch.no_grad():
+        return model(batch).transpose(1, 2)[:, delay:]
+
+def run(model, audio):
+    return process(model, as_tensor(audio).unsqueeze(0))[0].contiguous().numpy()
+
+def run_batch(model, requests):
+    # Pad clips to the same length, and run them through the model together.
+    clips = [as_tensor(args[0]) for args, kwargs in requests]
+    length = max(len(clip) for clip in clips)
+    batch = torch.stack([torch.nn.functional.pad(clip, (0, length - len(clip))) for clip in clips])
+    output = process(model, batch)
+    return [output[i, :len(clip)].contiguous().numpy() for i, clip in enumerate(clips)]
+
+if __name__ == "__main__":
+    import torchaudio
+
+    if len(sys.argv) < 4:
+        print(f"usage: {sys.argv[0]} <model path> <input path> <output path>")
+        exit()
+
+    audio, sr = torchaudio.load(sys.argv[2])
+    output = process(load(sys.argv[1]), audio.sum(axis=0).unsqueeze(0))[0]
 
-audio = torch.concatenate((audio.sum(axis=0), torch.zeros(delay))).reshape(1, 1, -1)
-with torch.no_grad():
-    output = model(audio).select(0, 0).T.contiguous()[delay:]
-
-# Avoiding torchaudio.save because it uses a funky format in the wave header (which Python's `wave` module can't read).
-with wave.open(sys.argv[3], "wb") as w:
-    channels = output.shape[1]
-    w.setnchannels(channels)
-    w.setsampwidth(2)
-    w.setframerate(sr)
-    w.writeframes((output * (2**15-1)).to(torch.int16).numpy())
+    # Avoiding torchaudio.save because it uses a funky format in the wave header (which Python's `wave` module can't read).
+    with wave.open(sys.argv[3], "wb") as w:
+        channels = output.shape[1]
+        w.setnchannels(channels)
+        w.setsampwidth(2)
+        w.setframerate(sr)
+        w.writeframes((output * (2**15-1)).to(torch.int16).numpy())
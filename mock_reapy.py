@@ -0,0 +1,445 @@
+# In-memory stand-in for the parts of reapy that lambdaw uses, so that it can run outside REAPER (see benchmark.py).
+# Install it with `sys.modules["reapy"] = mock_reapy` before importing lambdaw, and build a project with `Project.create`.
+# Objects are identified by pointer-like strings, as in reapy, and every edit bumps the project state change count.
+import array
+import itertools
+import os
+import re
+import struct
+import sys
+
+TICKS_PER_QN = 960
+
+objects = {}  # id -> object
+ids = itertools.count(1)
+ext_state = {}
+messages = []  # (kind, text) of everything shown to the user
+current = None
+
+def register(obj, kind):
+    obj.id = f"({kind}*)0x{next(ids):016X}"
+    objects[obj.id] = obj
+    return obj
+
+def changed():
+    if current is not None:
+        current.change_count += 1
+
+class Source:
+    def __init__(self, type, filename=""):
+        register(self, "PCM_source")
+        self.type = type
+        self.filename = filename
+        self.samples = None  # decoded audio, read from `filename` on first use
+        self.peaks_built = False
+
+    def read(self):
+        # First channel only, like an accessor asked for one channel.
+        if self.samples is None:
+            self.samples = array.array('d')
+            if self.filename and os.path.exists(self.filename):
+                channels, format_tag, width, data = read_wave(self.filename)
+                if (format_tag, width) == (1, 2):
+                    samples = array.array('h', data)
+                    scale = 2**15 - 1
+                elif (format_tag, width) == (3, 4):
+                    samples = array.array('f', data)
+                    scale = 1
+                else:
+                    samples, scale = [], 1
+                if sys.byteorder == "big":
+                    samples.byteswap()
+                self.samples = array.array('d', (x / scale for x in samples[::channels]))
+        return self.samples
+
+def read_wave(path):
+    # Returns (channels, format tag, bytes per sample, sample data) of a WAV file.
+    with open(path, "rb") as f:
+        data = f.read()
+    position, fmt = 12, None
+    while position + 8 <= len(data):
+        chunk_id, size = data[position:position + 4], int.from_bytes(data[position + 4:position + 8], "little")
+        if chunk_id == b"fmt ":
+            fmt = struct.unpack_from("<HH", data, position + 8) + struct.unpack_from("<H", data, position + 22)
+        elif chunk_id == b"data":
+            format_tag, channels, bits = fmt
+            return channels, format_tag, bits // 8, data[position + 8:position + 8 + size]
+        position += 8 + size + size % 2
+    return 1, 1, 2, b""
+
+class Note:
+    def __init__(self, take, infos):
+        self.take = take
+        self.infos_ppq = infos
+
+    @property
+    def infos(self):
+        infos = dict(self.infos_ppq)
+        infos["start"] = self.take.ppq_to_time(infos["start"])
+        infos["end"] = self.take.ppq_to_time(infos["end"])
+        return infos
+
+class AudioAccessor:
+    def __init__(self, take):
+        register(self, "AudioAccessor")
+        self.take = take
+        self.start_time = 0
+        self.end_time = take.item.length
+
+    def get_samples(self, start, n_samples, n_channels=1, sample_rate=44100):
+        samples = self.take.source.read()
+        offset = round((start + self.take.start_offset) * sample_rate)
+        block = list(samples[offset:offset + n_samples * n_channels])
+        return block + [0.0] * (n_samples * n_channels - len(block))
+
+    def delete(self):
+        objects.pop(self.id, None)
+
+class Take:
+    def __new__(cls, id=None):
+        # Like reapy, `Take(id)` refers to an existing take.
+        if id is not None:
+            return objects[id]
+        return super().__new__(cls)
+
+    def __init__(self, id=None):
+        if id is not None:
+            return
+        register(self, "MediaItem_Take")
+        self.guid = "{%08X-0000-0000-0000-000000000000}" % next(ids)
+        self.item = None
+        self.name = ""
+        self.source = Source("EMPTY")
+        self.start_offset = 0
+        self.playrate = 1
+        self.midi = []  # note infos with positions in PPQ
+        self.midi_hash = 0
+        self.fx = []  # lines of the take's FX chunk
+        self.envelopes = 0  # number of take envelopes (volume, pan, ...)
+        self.channel_mode = 0  # I_CHANMODE: 0 = normal, 1 = reverse stereo, 2 = mono (downmix), 3 = left, 4 = right
+
+    @property
+    def is_midi(self):
+        return self.source.type == "MIDI"
+
+    @property
+    def notes(self):
+        return [Note(self, infos) for infos in self.midi]
+
+    def time_to_ppq(self, time):
+        # NOTE: Relative to the start of the take, as in reapy (unlike note infos, which are in project time).
+        return current.time_to_beats(time) * TICKS_PER_QN
+
+    def ppq_to_time(self, ppq):
+        return self.item.position - self.start_offset + ppq / TICKS_PER_QN * 60 / current.bpm
+
+    def add_note(self, start, end, pitch, velocity=100, channel=0, selected=False, muted=False):
+        if not self.is_midi:
+            self.source = Source("MIDI")
+        self.midi.append({"start": self.time_to_ppq(start), "end": self.time_to_ppq(end), "pitch": pitch,
+                          "velocity": velocity, "channel": channel, "selected": selected, "muted": muted})
+        self.midi_hash += 1
+        changed()
+
+    def add_audio_accessor(self):
+        return AudioAccessor(self)
+
+    def get_info_value(self, key):
+        return {"D_PLAYRATE": self.playrate, "D_STARTOFFS": self.start_offset, "D_PITCH": 0, "D_VOL": 1,
+                "I_CHANMODE": self.channel_mode}[key]
+
+class Item:
+    def __init__(self, track, position, length):
+        register(self, "MediaItem")
+        self.track = track
+        self.position = position
+        self.length = length
+        self.takes = []
+        self.active_take = None
+        self.is_selected = False
+        self.info = {"C_LOCK": 0}
+
+    def add_take(self):
+        take = Take()
+        take.item = self
+        self.takes.append(take)
+        self.active_take = take
+        changed()
+        return take
+
+    def get_info_value(self, key):
+        if key == "IP_ITEMNUMBER":
+            return self.track.items.index(self)
+        if key == "D_POSITION":
+            return self.position
+        return self.info[key]
+
+    def set_info_value(self, key, value):
+        self.info[key] = value
+        changed()
+
+    def delete(self):
+        self.track.items.remove(self)
+        objects.pop(self.id, None)
+        for take in self.takes:
+            objects.pop(take.id, None)
+        changed()
+
+class Track:
+    def __init__(self, name=""):
+        register(self, "MediaTrack")
+        self.name = name
+        self.items = []
+
+    def add_item(self, start=0, end=None, length=0):
+        item = Item(self, start, length if end is None else end - start)
+        self.items.append(item)
+        self.items.sort(key=lambda item: item.position)
+        changed()
+        return item
+
+class Project:
+    def __new__(cls, id=None):
+        # Like reapy, `Project()` refers to the current project.
+        return current
+
+    @classmethod
+    def create(cls, path, bpm=120, bpi=4, name="benchmark.rpp"):
+        global current
+        project = current = object.__new__(cls)
+        register(project, "ReaProject")
+        project.path = path
+        project.name = name
+        project.bpm = bpm
+        project.bpi = bpi
+        project.tracks = []
+        project.change_count = 0
+        project.play_position = 0
+        project.is_playing = False
+        project.is_recording = False
+        project.sample_rate = 48000
+        project.ext_state = {}
+        return project
+
+    def __init__(self, id=None):
+        pass
+
+    @property
+    def time_signature(self):
+        return self.bpm, self.bpi
+
+    def time_to_beats(self, time):
+        return time * self.bpm / 60
+
+    def add_track(self, name=""):
+        track = Track(name)
+        self.tracks.append(track)
+        changed()
+        return track
+
+    def get_ext_state(self, section, key):
+        return self.ext_state.get((section, key), "")
+
+    def set_ext_state(self, section, key, value):
+        self.ext_state[(section, key)] = value
+
+def midi_chunk(take):
+    lines = ["<SOURCE MIDI", f"HASDATA 1 {TICKS_PER_QN} QN"]
+    events = []
+    for note in take.midi:
+        flags = ("e" if note["selected"] else "E") + ("m" if note["muted"] else "")
+        events.append((round(note["start"]), flags, f"{0x90 | note['channel']:02x} {note['pitch']:02x} {note['velocity']:02x}"))
+        events.append((round(note["end"]), flags, f"{0x80 | note['channel']:02x} {note['pitch']:02x} 00"))
+    position = 0
+    for ppq, flags, message in sorted(events):
+        lines.append(f"{flags} {ppq - position} {message}")
+        position = ppq
+    lines += ["E 0 b0 7b 00", ">"]
+    return lines
+
+def parse_midi_chunk(take, lines):
+    # Read notes back from the event lines of a MIDI source chunk.
+    take.midi = []
+    on = {}
+    position = 0
+    for line in lines:
+        match = re.match(r"([Ee]m?) (\d+) ([0-9a-f]{2}) ([0-9a-f]{2}) ([0-9a-f]{2})", line)
+        if not match:
+            continue
+        flags, delta, status, data1, data2 = match.groups()
+        position += int(delta)
+        status, pitch, velocity = int(status, 16), int(data1, 16), int(data2, 16)
+        if status & 0xF0 == 0x90 and velocity:
+            on[status & 0xF, pitch] = (position, velocity, flags)
+        elif status & 0xF0 in (0x80, 0x90) and (status & 0xF, pitch) in on:
+            start, velocity, flags = on.pop((status & 0xF, pitch))
+            take.midi.append({"start": start, "end": position, "pitch": pitch, "velocity": velocity, "channel": status & 0xF,
+                              "selected": flags.startswith("e"), "muted": "m" in flags})
+    take.midi_hash += 1
+
+class RPR:
+    # Subset of the ReaScript API, with reapy's conventions for return values.
+    def CountTracks(project_id):
+        return len(objects[project_id].tracks)
+
+    def GetTrack(project_id, index):
+        return objects[project_id].tracks[index].id
+
+    def CountTrackMediaItems(track_id):
+        return len(objects[track_id].items)
+
+    def GetTrackMediaItem(track_id, index):
+        return objects[track_id].items[index].id
+
+    def GetActiveTake(item_id):
+        take = objects[item_id].active_take
+        return "(MediaItem_Take*)0x0000000000000000" if take is None else take.id
+
+    def ValidatePtr(pointer, type):
+        return pointer in objects and pointer.startswith(f"({type}")
+
+    def ValidatePtr2(project_id, pointer, type):
+        return RPR.ValidatePtr(pointer, type)
+
+    def GetTakeName(take_id):
+        return objects[take_id].name
+
+    def GetMediaItemInfo_Value(item_id, key):
+        return objects[item_id].get_info_value(key)
+
+    def GetProjectStateChangeCount(project_id):
+        return objects[project_id].change_count
+
+    def GetSetMediaItemTakeInfo_String(take_id, key, value, is_set):
+        take = objects[take_id]
+        if key == "GUID":
+            return True, take_id, key, take.guid, is_set
+        if is_set:
+            take.name = value
+            changed()
+        return True, take_id, key, take.name, is_set
+
+    def GetMediaItemTakeInfo_Value(take_id, key):
+        take = objects[take_id]
+        if key == "IP_TAKENUMBER":
+            return take.item.takes.index(take)
+        return take.get_info_value(key)
+
+    def MIDI_GetProjTimeFromPPQPos(take_id, ppq):
+        return objects[take_id].ppq_to_time(ppq)
+
+    def TakeFX_GetCount(take_id):
+        return len(objects[take_id].fx)
+
+    def CountTakeEnvelopes(take_id):
+        return objects[take_id].envelopes
+
+    def GetTakeNumStretchMarkers(take_id):
+        return 0
+
+    def CountTempoTimeSigMarkers(project_id):
+        return 0
+
+    def GetMediaItemTake_Source(take_id):
+        return objects[take_id].source.id
+
+    def SetMediaItemTake_Source(take_id, source_id):
+        take = objects[take_id]
+        take.source = objects[source_id]
+        if take.is_midi:
+            take.midi = []
+        changed()
+
+    def MIDI_GetHash(take_id, notes_only, hash, size):
+        return True, take_id, notes_only, str(objects[take_id].midi_hash), size
+
+    def MIDI_Sort(take_id):
+        objects[take_id].midi.sort(key=lambda note: note["start"])
+
+    def PCM_Source_CreateFromFile(path):
+        return Source("WAVE", os.path.abspath(path)).id
+
+    def PCM_Source_CreateFromType(type):
+        return Source(type).id
+
+    def PCM_Source_Destroy(source_id):
+        objects.pop(source_id, None)
+
+    def PCM_Source_BuildPeaks(source_id, mode):
+        # Peaks are built in a single step: mode 0 starts, 1 reports there's nothing left to do, 2 finishes.
+        source = objects[source_id]
+        if mode == 0:
+            return 0 if source.peaks_built else 1
+        if mode == 2 and source.filename:
+            with open(source.filename + ".reapeaks", "wb") as f:
+                f.write(bytes(len(source.read()) // 256))
+            source.peaks_built = True
+        return 0
+
+    def get_config_var_string(name, buffer, size):
+        return True, name, str(TICKS_PER_QN), size
+
+    def GetItemStateChunk(item_id, chunk, size, is_undo):
+        item = objects[item_id]
+        lines = ["<ITEM", f"POSITION {item.position}", f"LENGTH {item.length}"]
+        for i, take in enumerate(item.takes):
+            if i:
+                lines.append("TAKE SEL" if take is item.active_take else "TAKE")
+            lines += midi_chunk(take) if take.is_midi else ["<SOURCE EMPTY", ">"]
+            if take.fx:
+                lines += ["<TAKEFX", *take.fx, ">"]
+        lines.append(">")
+        return True, item_id, "\n".join(lines), size, is_undo
+
+    def SetItemStateChunk(item_id, chunk, is_undo):
+        item = objects[item_id]
+        sections = [[]]
+        for line in chunk.split("\n"):
+            if line == "TAKE" or line.startswith("TAKE "):
+                sections.append([])
+            sections[-1].append(line)
+        for take, lines in zip(item.takes, sections):
+            if take.is_midi:
+                parse_midi_chunk(take, lines)
+        changed()
+        return True
+
+    def GetSetProjectInfo(project_id, desc, value, is_set):
+        project = objects[project_id]
+        return {"PROJECT_SRATE_USE": 1, "PROJECT_SRATE": project.sample_rate}[desc]
+
+    def GetAudioDeviceInfo(attribute, desc, size):
+        return True, attribute, str(current.sample_rate), size
+
+    def GetPlayState():
+        return int(current.is_playing) | 4 * int(current.is_recording)
+
+    def Undo_OnStateChange2(project_id, description):
+        pass
+
+    def Help_Set(text, is_temporary):
+        messages.append(("help", text))
+
+def get_ext_state(section, key):
+    return ext_state.get((section, key), "")
+
+def set_ext_state(section, key, value, persist=False):
+    ext_state[(section, key)] = value
+
+def delete_ext_state(section, key, persist=False):
+    ext_state.pop((section, key), None)
+
+def show_message_box(text, title=""):
+    messages.append(("message box", text))
+
+def show_console_message(text):
+    messages.append(("console", text))
+
+def print(*args):
+    messages.append(("console", " ".join(map(str, args))))
+
+def update_arrange():
+    pass
+
+def defer(callback):
+    pass
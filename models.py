@@ -0,0 +1,324 @@
+# Long-lived local servers for external generators (RAVE, MusicVAE, ...).
+# Running a model in a fresh process for every call pays for interpreter startup, importing torch/tensorflow,
+# and loading the model each time. Instead, `model_server(script, *args)` returns a function that sends its arguments
+# to a server process running `script`, which is started on first use, shared by every process that uses the same
+# script and arguments (lambdaw, workers, other projects), and shuts itself down after `IDLE_TIMEOUT` seconds without requests.
+#
+# A server script is a Python file defining:
+#   load(*args) -> model                    called once, when the server starts
+#   run(model, *args, **kwargs) -> result   called for each request
+#   run_batch(model, requests) -> results   (optional) called instead of `run` with every request that arrived together,
+#                                           as a list of (args, kwargs)
+# See misc/run_rave.py and misc/run_musicvae.py.
+#
+# Protocol: over a local socket. Servers only talk to clients that know the token in their port file, which (like the file's
+# directory) only the user can read: on connecting, each side proves it knows the token by signing a random challenge from the other (see `authenticate`).
+# After that, each message is a pickle plus the buffers it refers to, which are sent and received
+# separately (pickle protocol 5), so audio isn't copied into or out of the pickle stream.
+# Frame: HEADER (pickle size, buffer count), a size for each buffer, the pickle, then the buffers.
+#   client -> server: (request_id, args, kwargs)
+#   server -> client: (request_id, "result", result) or (request_id, "error", traceback)
+# Arrays (array.array, memoryviews, numpy arrays) arrive as memoryviews over the received bytes,
+# which `numpy.frombuffer`, `torch.frombuffer`, and lambdaw's output conversion all accept as they are.
+# This module doesn't depend on reapy, so it works the same in worker processes (see worker.py).
+import array
+import getpass
+import hashlib
+import hmac
+import importlib.util
+import io
+import json
+import os
+import pickle
+import secrets
+import selectors
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+HEADER = struct.Struct("!QI")
+BUFFER_SIZE = struct.Struct("!Q")
+IDLE_TIMEOUT = 300  # seconds
+STARTUP_TIMEOUT = 10  # seconds until a new server is accepting connections (it may still be loading its model)
+LOAD_ERROR_TIMEOUT = 5  # seconds that a server whose model failed to load keeps reporting the error
+AUTH_TIMEOUT = 5  # seconds for the other side to answer its challenge
+NONCE_SIZE = 16
+SIGNATURE_SIZE = 32
+
+def as_view(format, shape, buffer):
+    return memoryview(buffer).cast(format, shape)
+
+class Pickler(pickle.Pickler):
+    def reducer_override(self, obj):
+        # Send arrays as out-of-band buffers. numpy arrays are sent as plain memoryviews too,
+        # so that receiving them doesn't require numpy (which lambdaw avoids inside REAPER; see render.py).
+        if isinstance(obj, array.array) or hasattr(obj, "__array_interface__"):
+            obj = memoryview(obj)
+        if isinstance(obj, memoryview) and obj.c_contiguous:
+            try:
+                return as_view, (obj.format, obj.shape, pickle.PickleBuffer(obj.cast("B")))
+            except (TypeError, ValueError):
+                pass
+        return NotImplemented
+
+def server_dir():
+    # Directory for port files, private to the current user.
+    path = os.path.join(tempfile.gettempdir(), "lambdaw-models-" + getpass.getuser())
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if hasattr(os, "getuid"):
+        info = os.lstat(path)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+            raise RuntimeError(f"{path} must be a directory that only its owner can access")
+    return path
+
+def sign(token, role, nonce):
+    return hmac.new(token, role + nonce, "sha256").digest()
+
+def authenticate(sock, token, role):
+    # Challenge-response over a new connection, from the side of `role` (b"client" or b"server"); raises ConnectionError
+    # if the other side doesn't know the token. The token itself is never sent.
+    other = b"server" if role == b"client" else b"client"
+    sock.settimeout(AUTH_TIMEOUT)
+    nonce = secrets.token_bytes(NONCE_SIZE)
+    sock.sendall(nonce)
+    other_nonce = bytes(recv_into(sock, bytearray(NONCE_SIZE)))
+    sock.sendall(sign(token, role, other_nonce))
+    if not hmac.compare_digest(bytes(recv_into(sock, bytearray(SIGNATURE_SIZE))), sign(token, other, nonce)):
+        raise ConnectionError("connection failed authentication")
+    sock.settimeout(None)
+
+def send_message(sock, message):
+    buffers = []
+    data = io.BytesIO()
+    Pickler(data, protocol=5, buffer_callback=buffers.append).dump(message)
+    views = [buffer.raw() for buffer in buffers]
+    sock.sendall(HEADER.pack(len(data.getbuffer()), len(views)) + b"".join(BUFFER_SIZE.pack(len(view)) for view in views))
+    sock.sendall(data.getbuffer())
+    for view in views:
+        sock.sendall(view)
+
+def recv_into(sock, buffer):
+    view = memoryview(buffer)
+    while view:
+        count = sock.recv_into(view)
+        if not count:
+            raise EOFError("connection closed")
+        view = view[count:]
+    return buffer
+
+def recv_message(sock):
+    size, count = HEADER.unpack(recv_into(sock, bytearray(HEADER.size)))
+    sizes = [BUFFER_SIZE.unpack_from(recv_into(sock, bytearray(BUFFER_SIZE.size)))[0] for _ in range(count)]
+    data = recv_into(sock, bytearray(size))
+    return pickle.loads(data, buffers=[recv_into(sock, bytearray(size)) for size in sizes])
+
+
+# Client side.
+
+def server_name(script, args, python):
+    return hashlib.blake2b(repr((os.path.abspath(script), args, python)).encode("utf8"), digest_size=8).hexdigest()
+
+class ModelClient:
+    def __init__(self, script, args, python="python", idle_timeout=IDLE_TIMEOUT):
+        self.script = os.path.abspath(script)
+        self.args = args
+        self.python = python
+        self.idle_timeout = idle_timeout
+        self.port_path = os.path.join(server_dir(), server_name(script, args, python) + ".port")
+        self.sock = None
+        self.process = None
+        self.next_id = 0
+
+    def open_connection(self):
+        # Port file: "<port> <token in hex>"
+        with open(self.port_path) as f:
+            port, token = f.read().split()
+        sock = socket.create_connection(("127.0.0.1", int(port)))
+        try:
+            authenticate(sock, bytes.fromhex(token), b"client")
+        except:
+            sock.close()
+            raise
+        self.sock = sock
+
+    def connect(self):
+        # Connect to the running server, if any, or start one.
+        try:
+            self.open_connection()
+            return
+        except (OSError, ValueError):
+            pass
+        if self.process is not None:
+            self.process.poll()  # reap a server that shut down
+        started = time.monotonic()
+        self.process = subprocess.Popen([self.python, os.path.abspath(__file__),
+                                         self.script, self.port_path, str(self.idle_timeout), json.dumps(self.args)],
+                                        cwd=os.path.dirname(self.script))
+        while True:
+            try:
+                self.open_connection()
+                return
+            except (OSError, ValueError):
+                if self.process.poll() is not None:
+                    raise RuntimeError(f"model server for {self.script} exited with code {self.process.returncode}")
+                if time.monotonic() - started > STARTUP_TIMEOUT:
+                    self.process.kill()
+                    raise RuntimeError(f"model server for {self.script} didn't start within {STARTUP_TIMEOUT} seconds")
+                time.sleep(0.05)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def __call__(self, *args, **kwargs):
+        for attempt in range(2):
+            if self.sock is None:
+                self.connect()
+            request_id = self.next_id
+            self.next_id += 1
+            try:
+                send_message(self.sock, (request_id, args, kwargs))
+                while True:
+                    response_id, status, value = recv_message(self.sock)
+                    if response_id == request_id:
+                        break
+            except (OSError, EOFError):
+                # The server may have shut down (e.g. for being idle) since the last call, so try a new one.
+                self.close()
+                if attempt:
+                    raise
+                continue
+            if status == "error":
+                raise RuntimeError(f"model server for {self.script} failed:\n{value}")
+            return value
+
+# (script, args, python) -> client, one connection per process.
+clients = {}
+
+def model_server(script, *args, python="python", idle_timeout=IDLE_TIMEOUT):
+    # `script` is relative to the working directory (the project's lambdaw directory). `args` are passed to its `load`
+    # (and must be JSON-serializable). `python` is the interpreter to run the server with.
+    key = (os.path.abspath(script), args, python)
+    client = clients.get(key)
+    if client is None:
+        client = clients[key] = ModelClient(script, args, python, idle_timeout)
+    return client
+
+def close_clients():
+    for client in clients.values():
+        client.close()
+    clients.clear()
+
+
+# Server side.
+
+def load_script(path):
+    spec = importlib.util.spec_from_file_location("model_script", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def run_requests(script, model, requests):
+    # Returns a (status, value) for each (args, kwargs) request.
+    if hasattr(script, "run_batch") and len(requests) > 1:
+        try:
+            return [("result", result) for result in script.run_batch(model, requests)]
+        except:
+            return [("error", traceback.format_exc())] * len(requests)
+    responses = []
+    for args, kwargs in requests:
+        try:
+            responses.append(("result", script.run(model, *args, **kwargs)))
+        except:
+            responses.append(("error", traceback.format_exc()))
+    return responses
+
+def load_model(script_path, args, state):
+    try:
+        sys.path.insert(1, os.path.dirname(script_path))
+        script = load_script(script_path)
+        state.update(script=script, model=script.load(*args), error=None)
+    except:
+        state.update(script=None, model=None, error=traceback.format_exc())
+
+def serve(script_path, port_path, idle_timeout, args):
+    # Start accepting connections right away, so clients can queue requests while the model loads (in a thread).
+    listener = socket.create_server(("127.0.0.1", 0))
+    token = secrets.token_bytes(32)
+    port = f"{listener.getsockname()[1]} {token.hex()}"
+    tmp_path = port_path + f".{os.getpid()}.tmp"
+    with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+        f.write(port)
+    os.replace(tmp_path, port_path)
+    state = {}
+    loader = threading.Thread(target=load_model, args=(script_path, args, state), daemon=True)
+    loader.start()
+    loaded = False
+
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+    last_request = time.monotonic()
+    batch = []
+    while True:
+        # Requests that arrive together (from different clients) are handled as one batch.
+        # Those that arrive while the model is loading wait for it.
+        timeout = 1 if loaded else 0.05
+        while events := selector.select(timeout):
+            timeout = 0
+            for key, _ in events:
+                if key.fileobj is listener:
+                    connection, _ = listener.accept()
+                    try:
+                        authenticate(connection, token, b"server")
+                    except (OSError, EOFError):
+                        connection.close()
+                        continue
+                    selector.register(connection, selectors.EVENT_READ)
+                    continue
+                try:
+                    request_id, request_args, request_kwargs = recv_message(key.fileobj)
+                except (OSError, EOFError):
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    continue
+                batch.append((key.fileobj, request_id, (request_args, request_kwargs)))
+        if not loaded:
+            if loader.is_alive():
+                continue
+            loaded = True
+            last_request = time.monotonic()
+        if batch:
+            if state["error"] is not None:
+                responses = [("error", state["error"])] * len(batch)
+            else:
+                responses = run_requests(state["script"], state["model"], [request for *_, request in batch])
+            for (connection, request_id, _), (status, value) in zip(batch, responses):
+                try:
+                    send_message(connection, (request_id, status, value))
+                except OSError:
+                    pass
+            batch = []
+            last_request = time.monotonic()
+        elif time.monotonic() - last_request > (idle_timeout if state["error"] is None else LOAD_ERROR_TIMEOUT):
+            break
+    # Stop advertising this server (unless another one has replaced it already), then finish.
+    try:
+        with open(port_path) as f:
+            if f.read() == port:
+                os.unlink(port_path)
+    except OSError:
+        pass
+    listener.close()
+
+if __name__ == "__main__":
+    # Run from the module proper rather than __main__, so clients can unpickle the arrays this pickles (see `as_view`).
+    sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))
+    import models
+    models.serve(sys.argv[1], sys.argv[2], float(sys.argv[3]), json.loads(sys.argv[4]))
@@ -0,0 +1,221 @@
+# Columnar representation of MIDI notes, which is what MIDI items are converted to (see `lambdaw.read_notes`).
+# Notes are kept sorted by start time, in parallel arrays, so that reading, transforming, and slicing large takes is cheap.
+# For compatibility with code written for lists of note dicts (like `transpose` in the example project modules),
+# iterating over or indexing a NoteArray yields dict-like views of individual notes, and `+` concatenates.
+# Slicing gives a NoteArray, except for slices that go backwards, which give a list of views in that order.
+# Views are read-only, since the NoteArray may be an input that other expressions read too; `copy()` gives a plain dict.
+# This module doesn't depend on reapy, so NoteArrays can be sent to worker processes (see worker.py).
+import array
+import bisect
+from collections.abc import Mapping
+import itertools
+
+# Column name -> array typecode
+COLUMNS = {"start": "d", "end": "d", "pitch": "i", "velocity": "i", "channel": "i", "selected": "B", "muted": "B"}
+DEFAULTS = {"velocity": 100, "channel": 0, "selected": 0, "muted": 0}
+
+class NoteView(Mapping):
+    # A single note of a NoteArray, which reads through to its columns.
+    # Besides the columns, "dur" is available as `end - start`.
+    __slots__ = ("notes", "index")
+
+    def __init__(self, notes, index):
+        self.notes = notes
+        self.index = index
+
+    def __getitem__(self, key):
+        if key == "dur":
+            return self.notes.end[self.index] - self.notes.start[self.index]
+        if key not in COLUMNS:
+            raise KeyError(key)
+        value = getattr(self.notes, key)[self.index]
+        return bool(value) if COLUMNS[key] == "B" else value
+
+    def __setitem__(self, key, value):
+        raise TypeError("notes of a NoteArray are read-only; modify a copy (`note.copy()` or `{**note, ...}`) instead")
+
+    def __delitem__(self, key):
+        self[key] = None
+
+    def copy(self):
+        return dict(self)
+
+    def __iter__(self):
+        return itertools.chain(COLUMNS, ("dur",))
+
+    def __len__(self):
+        return len(COLUMNS) + 1
+
+    def __repr__(self):
+        return repr(dict(self))
+
+class NoteArray:
+    def __init__(self, start=(), end=(), pitch=(), velocity=None, channel=None, selected=None, muted=None):
+        columns = {"start": start, "end": end, "pitch": pitch, "velocity": velocity, "channel": channel, "selected": selected, "muted": muted}
+        count = len(columns["start"])
+        for name, typecode in COLUMNS.items():
+            values = columns[name]
+            if values is None:
+                values = array.array(typecode, [DEFAULTS[name]]) * count
+            elif not isinstance(values, array.array) or values.typecode != typecode:
+                values = array.array(typecode, values)
+            if len(values) != count:
+                raise ValueError(f"{name} has {len(values)} values, expected {count}")
+            setattr(self, name, values)
+        # Start times, and the running maximum of end times, for finding the notes in a time range (see `overlapping`).
+        self.interval_index = None
+        if any(a > b for a, b in zip(self.start, itertools.islice(self.start, 1, None))):
+            self.sort()
+
+    @classmethod
+    def from_notes(cls, notes):
+        # Build a NoteArray from note dicts (or views), which need at least "start", "end", and "pitch".
+        notes = list(notes)
+        return cls(**{name: [note.get(name, DEFAULTS.get(name)) for note in notes] for name in COLUMNS})
+
+    def sort(self):
+        order = sorted(range(len(self)), key=self.start.__getitem__)
+        for name, typecode in COLUMNS.items():
+            values = getattr(self, name)
+            setattr(self, name, array.array(typecode, [values[i] for i in order]))
+        self.interval_index = None
+
+    def select(self, indices):
+        # New NoteArray with the notes at `indices` (in increasing order).
+        return NoteArray(**{name: array.array(typecode, [getattr(self, name)[i] for i in indices]) for name, typecode in COLUMNS.items()})
+
+    def replace(self, **columns):
+        # New NoteArray sharing the columns that aren't replaced.
+        return NoteArray(**{name: columns.get(name, getattr(self, name)) for name in COLUMNS})
+
+    def __len__(self):
+        return len(self.start)
+
+    def __iter__(self):
+        return (NoteView(self, i) for i in range(len(self)))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            indices = range(len(self))[index]
+            if indices.step < 0:
+                # A NoteArray is always in start order, so slices that go backwards (e.g. `notes[::-1]`) are lists of views.
+                return [NoteView(self, i) for i in indices]
+            return self.select(indices)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("note index out of range")
+        return NoteView(self, index)
+
+    def __repr__(self):
+        return f"NoteArray({self.to_dicts()!r})"
+
+    def __add__(self, other):
+        # Concatenate with another NoteArray, or with note dicts (as lists of notes would). The result is sorted again.
+        if not isinstance(other, NoteArray):
+            try:
+                other = NoteArray.from_notes(other)
+            except (TypeError, AttributeError):
+                return NotImplemented
+        return NoteArray(**{name: getattr(self, name) + getattr(other, name) for name in COLUMNS})
+
+    def __radd__(self, other):
+        try:
+            other = NoteArray.from_notes(other)
+        except (TypeError, AttributeError):
+            return NotImplemented
+        return other + self
+
+    def to_dicts(self):
+        return [{name: value for name, value in note.items() if name != "dur"} for note in self]
+
+    def memo_key(self):
+        # Identifies the notes for `memoize` (see memo.py).
+        return ("notes",) + tuple(getattr(self, name) for name in COLUMNS)
+
+    def shift(self, seconds):
+        return self.replace(start=array.array('d', [t + seconds for t in self.start]),
+                            end=array.array('d', [t + seconds for t in self.end]))
+
+    def retime(self, fn):
+        # Apply `fn` to all start and end times, which must keep them in the same order (e.g. converting between units).
+        cache = {}
+        def convert(t):
+            if t not in cache:
+                cache[t] = fn(t)
+            return cache[t]
+        return self.replace(start=array.array('d', map(convert, self.start)), end=array.array('d', map(convert, self.end)))
+
+    def transpose(self, semitones):
+        return self.replace(pitch=array.array('i', [p + semitones for p in self.pitch]))
+
+    def overlapping(self, start, end):
+        # Indices of the notes sounding at some point in [start, end).
+        if self.interval_index is None:
+            if any(a > b for a, b in zip(self.start, itertools.islice(self.start, 1, None))):
+                self.sort()
+            self.interval_index = array.array('d', itertools.accumulate(self.end, max))
+        last = bisect.bisect_left(self.start, end)
+        # The running maximum of end times only increases, so everything before `first` ends by `start`.
+        first = bisect.bisect_right(self.interval_index, start)
+        return [i for i in range(first, last) if self.end[i] > start]
+
+    def between(self, start, end):
+        # Notes sounding at some point in [start, end), unclipped.
+        return self.select(self.overlapping(start, end))
+
+NOTE_FLAGS = {"E", "e", "Em", "em"}
+OTHER_FLAGS = {"X", "x", "Xm", "xm", "<X", "<x", "<Xm", "<xm"}
+
+def parse_source(lines):
+    # Read the notes from the lines of a MIDI source chunk, starting with "<SOURCE MIDI" (anything after its end is ignored),
+    # with positions in ticks. Returns (ticks per quarter note, NoteArray), or None if the chunk holds no event data.
+    ticks = None
+    position = 0
+    depth = 0
+    held = {}  # (channel, pitch) -> [(start, velocity, flags)], oldest first
+    starts, ends, pitches, velocities, channels, selected, muted = ([] for _ in COLUMNS)
+    def add_note(start, end, pitch, velocity, channel, flags):
+        starts.append(start)
+        ends.append(end)
+        pitches.append(pitch)
+        velocities.append(velocity)
+        channels.append(channel)
+        selected.append(flags[0] == "e")
+        muted.append(flags[-1] == "m")
+    for line in lines:
+        parts = line.split()
+        if not parts:
+            continue
+        kind = parts[0]
+        # Event lines start with flags ("e" for selected, "m" for muted) and the delta in ticks from the previous event.
+        if kind in NOTE_FLAGS:
+            position += int(parts[1])
+            if len(parts) < 5:
+                continue
+            status, pitch, velocity = int(parts[2], 16), int(parts[3], 16), int(parts[4], 16)
+            message, channel = status & 0xF0, status & 0xF
+            if message == 0x90 and velocity:
+                held.setdefault((channel, pitch), []).append((position, velocity, kind))
+            elif message in (0x80, 0x90) and held.get((channel, pitch)):
+                start, velocity, flags = held[channel, pitch].pop(0)
+                add_note(start, position, pitch, velocity, channel, flags)
+            continue
+        if kind in OTHER_FLAGS:
+            # Sysex and text events, possibly in a block.
+            position += int(parts[1])
+        if kind[0] == "<":
+            depth += 1
+        elif kind == ">":
+            depth -= 1
+            if depth == 0:
+                break
+        elif kind == "HASDATA" and len(parts) > 2:
+            ticks = int(parts[2])
+    if ticks is None:
+        return None
+    # Notes left on last until the end of the source.
+    for (channel, pitch), notes in held.items():
+        for start, velocity, flags in notes:
+            add_note(start, position, pitch, velocity, channel, flags)
+    return ticks, NoteArray(starts, ends, pitches, velocities, channels, selected, muted)
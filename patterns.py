@@ -0,0 +1,86 @@
+# Output conversion for Vortex (https://github.com/tidalcycles/vortex) patterns.
+# An expression that evaluates to a pattern fills its item with the pattern's events over the cycles the item spans,
+# where a cycle is `lambdaw.CYCLE_LENGTH` seconds (a bar, at the project's tempo) counted from the start of the project.
+# Patterns are queried a cycle at a time, and the results are cached for patterns that stick around
+# (e.g. defined in the project module), so each livecoded cycle only costs the events in that cycle.
+# vortex is optional, and only ever imported by the project module; this module doesn't depend on it (or on reapy).
+from fractions import Fraction
+import math
+import numbers
+import re
+import sys
+import weakref
+
+from notearray import NoteArray
+
+# pattern -> {(begin, end): [(onset, offset, value)]}, in cycles
+query_cache = weakref.WeakKeyDictionary()
+MAX_CACHED_SPANS = 256  # per pattern
+# Item positions are rounded to this many steps per cycle, so that float positions don't turn into unwieldy fractions.
+RESOLUTION = 3840
+
+def is_pattern(obj):
+    return type(obj).__module__.split(".")[0] == "vortex" and callable(getattr(obj, "query", None))
+
+def to_cycles(seconds, cycle_length):
+    return Fraction(round(seconds / cycle_length * RESOLUTION), RESOLUTION)
+
+def query(pattern, begin, end):
+    # Events with onsets in [begin, end), as (onset, offset, value) with times in cycles.
+    try:
+        spans = query_cache.setdefault(pattern, {})
+    except TypeError:
+        spans = {}  # can't be cached
+    events = spans.get((begin, end))
+    if events is None:
+        TimeSpan = sys.modules[type(pattern).__module__.split(".")[0]].TimeSpan
+        events = []
+        for event in pattern.query(TimeSpan(begin, end)):
+            # Skip fragments of events that started before the span, and continuous events (which have no onset).
+            if event.whole is not None and event.whole.begin == event.part.begin:
+                events.append((event.whole.begin, event.whole.end, event.value))
+        if len(spans) >= MAX_CACHED_SPANS:
+            del spans[next(iter(spans))]
+        spans[begin, end] = events
+    return events
+
+note_regex = re.compile(r"([A-Ga-g])([#sfb]?)(\d*)$")
+note_names = "cdefgab"
+major_scale = [0, 2, 4, 5, 7, 9, 11]
+accidentals = {"": 0, "#": 1, "s": 1, "b": -1, "f": -1}
+
+def note_to_pitch(note):
+    if isinstance(note, numbers.Real):
+        return note
+    name, accidental, octave = note_regex.match(note).groups()
+    octave = int(octave) if octave else 4
+    return major_scale[note_names.index(name.lower())] + accidentals[accidental] + (octave + 1) * 12
+
+def event_note(value):
+    # Note fields from an event value: {"note": ...} or {"n": ...}, optionally with "velocity" (or "gain"), from 0 to 1 as in
+    # Tidal, and "channel". Returns None for events without a pitch.
+    if not isinstance(value, dict):
+        value = {"note": value}
+    pitch = value.get("note", value.get("n"))
+    if not isinstance(pitch, (numbers.Real, str)):
+        return None
+    velocity = value.get("velocity", value.get("gain", 100 / 127)) * 127
+    # A velocity of 0 would make the note-on a note-off.
+    return round(note_to_pitch(pitch)), min(max(round(velocity), 1), 127), value.get("channel", 0)
+
+def to_notes(pattern, position, length, cycle_length):
+    # The pattern's notes within an item at `position` (seconds) lasting `length`, with times relative to the item.
+    begin = to_cycles(position, cycle_length)
+    end = to_cycles(position + length, cycle_length)
+    starts, ends, pitches, velocities, channels = [], [], [], [], []
+    for cycle in range(math.floor(begin), math.ceil(end)):
+        for onset, offset, value in query(pattern, max(begin, Fraction(cycle)), min(end, Fraction(cycle + 1))):
+            note = event_note(value)
+            if note is None:
+                continue
+            starts.append(float(onset - begin) * cycle_length)
+            ends.append(float(min(offset, end) - begin) * cycle_length)
+            pitches.append(note[0])
+            velocities.append(note[1])
+            channels.append(note[2])
+    return NoteArray(starts, ends, pitches, velocities, channels)
@@ -0,0 +1,4 @@
+import reapy
+
+# Print a summary of how long each expression took to the console, and save the details to profile.json/profile.csv.
+reapy.set_ext_state("lambdaw", "pending", "profile_report")
@@ -0,0 +1,12 @@
+import reapy
+
+# Toggle running the selected item's expression under cProfile whenever it is evaluated (see profiling.py).
+project = reapy.Project()
+name = project.selected_items[0].active_take.name.split("=", 1)[0] if project.n_selected_items else ""
+if not name or reapy.get_ext_state("lambdaw", "profile") == name:
+    reapy.delete_ext_state("lambdaw", "profile")
+    reapy.show_console_message("lambdaw: profiling disabled\n")
+else:
+    reapy.set_ext_state("lambdaw", "profile", name)
+    reapy.set_ext_state("lambdaw", "pending", "eval_selected")
+    reapy.show_console_message(f"lambdaw: profiling {name}\n")
@@ -0,0 +1,97 @@
+# Per-expression instrumentation.
+# Each evaluation records how long it took (evaluating the expression, converting its output, building peaks)
+# and how much it produced, so that a sluggish session can be traced back to the expressions responsible.
+# Records are kept in memory, and can be queried, summarized, or dumped to JSON/CSV.
+# This module doesn't depend on reapy, so worker.py can use `profiled` too.
+import collections
+import cProfile
+import csv
+import io
+import json
+import pstats
+import time
+
+MAX_RECORDS = 10000
+FIELDS = ["time", "var_name", "expression", "take", "cached", "error",
+          "eval_time", "convert_time", "peaks_time", "frames", "notes", "bytes"]
+
+class Profiler:
+    def __init__(self, max_records=MAX_RECORDS):
+        self.records = collections.deque(maxlen=max_records)
+        self.scans = collections.deque(maxlen=max_records)
+        # Record of the evaluation in progress, which conversion functions add their output counts to.
+        self.current = None
+
+    def start(self, var_name, expression, take_id):
+        self.current = {"time": time.time(), "var_name": var_name, "expression": expression, "take": take_id,
+                        "cached": False, "error": False, "eval_time": 0, "convert_time": 0, "peaks_time": 0,
+                        "frames": 0, "notes": 0, "bytes": 0}
+        return self.current
+
+    def output(self, **counts):
+        if self.current is not None:
+            for field, count in counts.items():
+                self.current[field] += count
+
+    def finish(self, record):
+        self.records.append(record)
+        if record is self.current:
+            self.current = None
+
+    def scan(self, duration, takes):
+        self.scans.append({"time": time.time(), "duration": duration, "takes": takes})
+
+    def select(self, where=None, order_by=None, limit=None, **equals):
+        # Query records, e.g. `select(var_name="a")` or `select(where=lambda r: r["eval_time"] > 1, order_by="-eval_time")`.
+        rows = [record for record in self.records
+                if all(record[field] == value for field, value in equals.items()) and (where is None or where(record))]
+        if order_by is not None:
+            field = order_by.lstrip("-")
+            rows.sort(key=lambda record: record[field], reverse=order_by.startswith("-"))
+        return rows[:limit]
+
+    def summary(self):
+        # Totals per variable name, most expensive first.
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record["var_name"], {
+                "var_name": record["var_name"], "count": 0, "cached": 0, "errors": 0, "total_time": 0, "max_time": 0,
+                "frames": 0, "notes": 0, "bytes": 0})
+            elapsed = record["eval_time"] + record["convert_time"] + record["peaks_time"]
+            total["count"] += 1
+            total["cached"] += record["cached"]
+            total["errors"] += record["error"]
+            total["total_time"] += elapsed
+            total["max_time"] = max(total["max_time"], elapsed)
+            for field in ("frames", "notes", "bytes"):
+                total[field] += record[field]
+        return sorted(totals.values(), key=lambda total: total["total_time"], reverse=True)
+
+    def format_summary(self, limit=10):
+        lines = [f"{'variable':<16}{'runs':>6}{'cached':>8}{'errors':>8}{'total':>10}{'max':>10}{'frames':>12}{'notes':>8}{'MB':>8}"]
+        for total in self.summary()[:limit]:
+            lines.append(f"{total['var_name'][:15]:<16}{total['count']:>6}{total['cached']:>8}{total['errors']:>8}"
+                         f"{total['total_time']:>9.3f}s{total['max_time']:>9.3f}s{total['frames']:>12}{total['notes']:>8}"
+                         f"{total['bytes'] / 1024**2:>8.1f}")
+        if self.scans:
+            durations = [scan["duration"] for scan in self.scans]
+            lines.append(f"{len(durations)} scans: mean {sum(durations) / len(durations) * 1000:.2f}ms, max {max(durations) * 1000:.2f}ms")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        # Save records as CSV (if `path` ends in .csv) or as JSON, along with scans.
+        with open(path, "w", newline="") as f:
+            if path.endswith(".csv"):
+                writer = csv.DictWriter(f, FIELDS)
+                writer.writeheader()
+                writer.writerows(self.records)
+            else:
+                json.dump({"records": list(self.records), "scans": list(self.scans)}, f, indent=1)
+
+def profiled(fn, *args):
+    # Call `fn` under cProfile. Returns (its result, a report of the most expensive functions).
+    profile = cProfile.Profile()
+    result = profile.runcall(fn, *args)
+    stream = io.StringIO()
+    pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(25)
+    return result, stream.getvalue()
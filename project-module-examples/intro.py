@@ -65,19 +65,17 @@ def log(x):
 
 # The multiprocessing module also doesn't work within REAPER. :-(
 
-# So, for the moment, we do it in a hacky way: just run RAVE in a separate Python process.
-# (Long-term solution is to just do all evaluation in a separate Python process.)
+# So we run RAVE in a separate Python process: a model server (see lambdaw's models.py),
+# which keeps the model loaded between calls and shuts down once it's been idle for a while.
+import array
 import os
 import subprocess
 import tempfile
+import lambdaw
 
 def rave(model_path, audio):
-    with tempfile.TemporaryDirectory() as dir:
-        path = os.path.join(dir, "tmp.wav")
-        wav.save(audio, path)
-        if subprocess.run(["python", "run_rave.py", model_path + ".ts", path, path]).returncode:
-            raise RuntimeError("Failed to run RAVE")
-        return wav.load(path)
+    samples = array.array('f', audio.read() if hasattr(audio, "read") else audio)
+    return lambdaw.model_server("run_rave.py", model_path + ".ts")(samples)
 
 
 # Experiment with MusicVAE
@@ -85,13 +83,8 @@ def rave(model_path, audio):
 # Same issue as RAVE: we'd like to run the model directly,
 # but importing Tensorflow causes REAPER to deadlock.
 
-import ast
-
-def musicvae(model):
-    result = subprocess.run(["python", "run_musicvae.py", model], capture_output=True)
-    if result.returncode:
-        raise RuntimeError("Failed to run MusicVAE:\n" + result.stderr.decode("utf8"))
-    return ast.literal_eval(result.stdout.decode("utf8"))
+def musicvae(model, temperature=0.5):
+    return lambdaw.model_server("run_musicvae.py", model)(temperature=temperature)
 
 
 # Use DECTalk to speak and sing.
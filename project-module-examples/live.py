@@ -4,6 +4,9 @@ from aleatora import *
 # Here, we override LambDAW's default behavior to
 # control how it converts Python values into DAW items.
 def custom_convert_output(output, *args):
+    # Patterns (see below) are handled by the default converter.
+    if isinstance(output, vortex.Pattern):
+        return lambdaw.convert_output(output, *args)
     # `output` may be a (potentially endless) iterable.
     # So, we peek at the first item in order to determine the type.
     first, output = lambdaw.peek(output)
@@ -32,37 +35,18 @@ def transpose(notes, offset):
 
 # Experiment with Vortex for Tidal notation.
 # (Requires latest: `pip install "tidalvortex @ git+https://github.com/tidalcycles/vortex@main"`)
-import re
-import numbers
+# Expressions that evaluate to patterns are converted to MIDI by lambdaw (see patterns.py),
+# filling the item with however many cycles (bars) it spans, so patterns can be used directly:
+#   =note("c d e g")
+#   =note("e d c d e e e ~").slow(2)
+# and on a track named with an expression while recording, each new cycle only queries that cycle.
 import vortex
 from vortex import note  # for use in expressions
 
-note_regex = re.compile("([A-Ga-g])([#b]?)(\d*)")
-note_names = "cdefgab"
-major_scale = [0, 2, 4, 5, 7, 9, 11]
-accidentals = {'': 0, '#': 1, 'b': -1}
-
-def note_to_pitch(note):
-    if isinstance(note, numbers.Real):
-        return note
-    name, accidental, octave = note_regex.match(note).groups()
-    name = name.lower()
-    accidental = accidentals[accidental]
-    octave = int(octave) if octave else 4
-    return major_scale[note_names.index(name)] + accidental + (octave + 1) * 12
-
-# TODO: Try custom converter for `vortex.Pattern` instead of using `n()`;
-#       consider using length of item to determine number of cycles rather than taking argument.
-# Ex:
-#   =n("c d e g")
-#   =n("c [e g] <a*3 b*3> c5*4", 2)
-#   =n(note("e d c d e e e ~").slow(2), 2)
-def n(pattern, cycles=1):
-    if isinstance(pattern, str):
-        pattern = vortex.note(pattern)
-    for event in pattern.query(vortex.TimeSpan(0, cycles)):
-        # TODO: Respect cycle length / project time signature
-        yield {"pitch": note_to_pitch(event.value["note"]), "start": float(event.part.begin), "end": float(event.part.end)}
+# Shorthand for note patterns:
+#   =n("c [e g] <a*3 b*3> c5*4")
+def n(pattern):
+    return vortex.note(pattern) if isinstance(pattern, str) else pattern
 
 
 # Experiment with RAVE
@@ -73,20 +57,13 @@ def n(pattern, cycles=1):
 
 # The multiprocessing module also doesn't work within REAPER. :-(
 
-# So, for the moment, we do it in a hacky way: just run RAVE in a separate Python process.
-# (Long-term solution is to just do all evaluation in a separate Python process.)
-import os
-import subprocess
-import tempfile
+# So we run RAVE in a separate Python process: a model server (see lambdaw's models.py),
+# which keeps the model loaded between calls and shuts down once it's been idle for a while.
+import array
 
 def rave(model_path, audio):
-    with tempfile.TemporaryDirectory() as dir:
-        path = os.path.join(dir, "tmp.wav")
-        wav.save(audio, path)
-        if subprocess.run(["python", "run_rave.py", model_path + ".ts", path, path]).returncode:
-            raise RuntimeError("Failed to run RAVE")
-        result = wav.load(path)
-    return result
+    samples = array.array('f', audio.read() if hasattr(audio, "read") else audio)
+    return lambdaw.model_server("run_rave.py", model_path + ".ts")(samples)
 
 
 # Experiment with MusicVAE
@@ -94,10 +71,5 @@ def rave(model_path, audio):
 # Same issue as RAVE: we'd like to run the model directly,
 # but importing Tensorflow causes REAPER to deadlock.
 
-import ast
-
-def musicvae(model):
-    result = subprocess.run(["python", "run_musicvae.py", model], capture_output=True)
-    if result.returncode:
-        raise RuntimeError("Failed to run MusicVAE:\n" + result.stderr.decode("utf8"))
-    return ast.literal_eval(result.stdout.decode("utf8"))
+def musicvae(model, temperature=0.5):
+    return lambdaw.model_server("run_musicvae.py", model)(temperature=temperature)
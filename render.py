@@ -0,0 +1,394 @@
+# Conversion of expression values into media files.
+# This module doesn't depend on reapy, so it can be shared by lambdaw (inside REAPER) and worker.py (outside it).
+import array
+from collections.abc import Mapping
+import itertools
+import mmap
+import numbers
+import os
+import struct
+import sys
+import time
+
+from notearray import NoteArray
+
+SAMPLE_RATE = 48000
+BLOCK_SIZE = 16384  # samples
+SCALE = 2**15 - 1
+# Sample format name -> (WAV format tag, bytes per sample)
+SAMPLE_FORMATS = {
+    "int16": (1, 2),
+    "int24": (1, 3),
+    "float32": (3, 4),
+}
+# Limits per render, so that an endless or runaway expression can't hang REAPER or fill up the disk.
+TIME_LIMIT = None  # seconds per render, unless a project sets its own (see `parse_time_limit`); None for no limit
+MAX_LENGTH = 60 * 60 * SAMPLE_RATE  # frames, for renders without a given length
+
+class RenderLimitExceeded(Exception):
+    pass
+
+def parse_time_limit(text):
+    # A time limit setting (the "lambdaw"/"time_limit" project ext state), in seconds: 0 for no limit,
+    # or None to use `TIME_LIMIT` if it's unset or invalid.
+    try:
+        return max(0, float(text))
+    except (TypeError, ValueError):
+        return None
+
+# NOTE: Avoiding numpy inside REAPER due to segfault on reload: https://github.com/numpy/numpy/issues/11925
+# The worker process never reloads modules, so it can opt in with `enable_numpy()`.
+numpy = None
+
+def enable_numpy():
+    global numpy
+    try:
+        import numpy
+    except ImportError:
+        pass
+
+def as_buffer(obj):
+    # Return a flat memoryview of `obj` if it supports the buffer protocol (array.array, memoryview, numpy arrays...).
+    if isinstance(obj, (str, bytes, bytearray)):
+        return None
+    try:
+        view = memoryview(obj)
+    except TypeError:
+        return None
+    if view.ndim != 1:
+        view = view.cast("B").cast(view.format)
+    return view
+
+def blocks(it, length=None, block_size=BLOCK_SIZE):
+    # Split audio into blocks of at most `block_size` samples, stopping after `length` samples.
+    # `it` may be a buffer, an iterable of buffers, or (the slow path) an iterable of individual samples.
+    buffer = as_buffer(it)
+    if buffer is not None:
+        buffers = (buffer,)
+    elif hasattr(it, "blocks"):
+        # e.g. `lambdaw.AudioInput`
+        buffers = map(as_buffer, it.blocks())
+    else:
+        first, it = peek(it, default=())
+        if as_buffer(first) is not None:
+            buffers = map(as_buffer, it)
+        else:
+            buffers = iter(lambda: array.array('d', itertools.islice(it, block_size)), array.array('d'))
+    return split(buffers, length, block_size)
+
+def split(buffers, length, block_size, channels=1):
+    # Re-cut a stream of frame-interleaved buffers into blocks of at most `block_size` frames, stopping after `length` frames.
+    step = block_size * channels
+    remaining = None if length is None else length * channels
+    for buffer in buffers:
+        for start in range(0, len(buffer), step):
+            block = buffer[start:start + step]
+            if remaining is not None:
+                block = block[:remaining]
+                remaining -= len(block)
+            yield block
+            if remaining == 0:
+                return
+
+class Reader:
+    # Reads a stream of blocks in pieces of a given size.
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.buffer = array.array('d')
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            block = next(self.blocks, None)
+            if block is None:
+                break
+            if getattr(block, "format", getattr(block, "typecode", None)) == "d":
+                self.buffer.frombytes(memoryview(block).cast("B"))
+            else:
+                self.buffer.extend(block)
+        result, self.buffer = self.buffer[:size], self.buffer[size:]
+        return result
+
+def interleave(channels):
+    # Interleave equal-length per-channel buffers into one buffer of frames.
+    if len(channels) == 1:
+        return channels[0]
+    if numpy is not None:
+        return numpy.stack([numpy.asarray(channel, dtype=numpy.float64) for channel in channels], axis=1).ravel()
+    frames = array.array('d', bytes(8 * len(channels) * len(channels[0])))
+    for i, channel in enumerate(channels):
+        if not (isinstance(channel, array.array) and channel.typecode == "d"):
+            channel = array.array('d', channel)
+        frames[i::len(channels)] = channel
+    return frames
+
+def as_frames(obj):
+    # Return (channels, frame-interleaved buffer) if `obj` supports the buffer protocol.
+    # In a 2D buffer, the smaller dimension is taken to be channels, so both (frames, channels) and (channels, frames) work.
+    buffer = as_buffer(obj)
+    if buffer is None:
+        return None
+    shape = memoryview(obj).shape
+    if len(shape) != 2 or shape[0] >= shape[1]:
+        return (shape[1] if len(shape) == 2 else 1), buffer
+    rows, columns = shape
+    return rows, interleave([buffer[i * columns:(i + 1) * columns] for i in range(rows)])
+
+def channel_blocks(it, length=None, block_size=BLOCK_SIZE):
+    # Split audio with any number of channels into blocks of at most `block_size` frames, stopping after `length` frames.
+    # Returns (channels, blocks of frame-interleaved samples). Besides anything `blocks` accepts (for mono audio), `it` may be
+    # a tuple of per-channel signals, a 2D buffer (see `as_frames`), an iterable of 2D buffers, or an iterable of frames (tuples).
+    if isinstance(it, tuple) and it and not isinstance(it[0], numbers.Real):
+        readers = [Reader(blocks(channel, length, block_size)) for channel in it]
+        def generate():
+            while True:
+                parts = [reader.read(block_size) for reader in readers]
+                size = max(map(len, parts))
+                if not size:
+                    return
+                for part in parts:
+                    # Shorter channels are padded with silence.
+                    part.extend(itertools.repeat(0.0, size - len(part)))
+                yield interleave(parts)
+        return len(it), generate()
+    frames = as_frames(it)
+    if frames is not None:
+        channels, buffer = frames
+        return channels, split((buffer,), length, block_size, channels)
+    if hasattr(it, "blocks"):
+        return 1, blocks(it, length, block_size)
+    first, it = peek(it, default=())
+    if isinstance(first, (tuple, list)):
+        buffers = iter(lambda: array.array('d', itertools.chain.from_iterable(itertools.islice(it, block_size))), array.array('d'))
+        return len(first), split(buffers, length, block_size, len(first))
+    frames = as_frames(first)
+    if frames is not None and frames[0] > 1:
+        return frames[0], split((as_frames(buffer)[1] for buffer in it), length, block_size, frames[0])
+    return 1, blocks(it, length, block_size)
+
+def convert_block(block, sample_format="int16"):
+    # Convert a block of float samples to little-endian sample data. Integer formats are clipped to [-1, 1].
+    if sample_format == "float32":
+        if numpy is not None:
+            return numpy.asarray(block, dtype="<f4").tobytes()
+        data = array.array('f', block)
+    else:
+        scale = SCALE if sample_format == "int16" else 2**23 - 1
+        if numpy is not None:
+            data = (numpy.clip(numpy.asarray(block, dtype=numpy.float64), -1, 1) * scale).astype("<i2" if sample_format == "int16" else "<i4")
+            if sample_format == "int24":
+                return data.view(numpy.uint8).reshape(-1, 4)[:, :3].tobytes()
+            return data.tobytes()
+        data = array.array('h' if sample_format == "int16" else 'i',
+                           [int(x * scale) if -1 <= x <= 1 else (scale if x > 0 else -scale) for x in block])
+    if sys.byteorder == "big":
+        data.byteswap()
+    if sample_format == "int24":
+        # Drop the most significant byte of each 32-bit sample.
+        data = bytearray(data.tobytes())
+        del data[3::4]
+    return data
+
+class WaveWriter:
+    # Minimal WAV writer. Unlike the `wave` module, it supports 24-bit and floating-point samples.
+    def __init__(self, path, channels=1, sample_rate=SAMPLE_RATE, sample_format="int16"):
+        self.format_tag, self.sample_width = SAMPLE_FORMATS[sample_format]
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.data_size = 0
+        self.file = open(path, "wb")
+        self.write_header()
+
+    def write_header(self):
+        block_align = self.channels * self.sample_width
+        fmt = struct.pack("<HHIIHH", self.format_tag, self.channels, self.sample_rate,
+                          self.sample_rate * block_align, block_align, 8 * self.sample_width)
+        if self.format_tag != 1:
+            # Non-PCM formats have an extension size field and a "fact" chunk with the number of frames.
+            fmt += struct.pack("<H", 0)
+            chunks = b"fmt " + struct.pack("<I", len(fmt)) + fmt + b"fact" + struct.pack("<II", 4, self.data_size // block_align)
+        else:
+            chunks = b"fmt " + struct.pack("<I", len(fmt)) + fmt
+        chunks += b"data" + struct.pack("<I", self.data_size)
+        riff_size = 4 + len(chunks) + self.data_size + self.data_size % 2
+        self.file.seek(0)
+        self.file.write(b"RIFF" + struct.pack("<I", riff_size) + b"WAVE" + chunks)
+
+    def write(self, data):
+        self.file.write(data)
+        self.data_size += memoryview(data).nbytes
+
+    def close(self):
+        if self.data_size % 2:
+            self.file.write(b"\0")  # chunks are padded to an even size
+        self.write_header()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class WaveFile:
+    # Read-only memory map of an uncompressed WAV file, whose samples can be viewed without copying them.
+    # Raises ValueError for files it can't map (compressed data, or a big-endian host). 24-bit files can't be viewed either,
+    # so they're rejected too, unless `packed`: then `samples` is None, and they can only be read (converted) with `read`.
+    # Sample format (format tag, bytes per sample) -> (typecode, scale to [-1, 1], or None for float samples)
+    TYPECODES = {(1, 2): ("h", 2**15), (1, 4): ("i", 2**31), (3, 4): ("f", None)}
+
+    def __init__(self, path, packed=False):
+        if sys.byteorder != "little":
+            raise ValueError("WAV files can only be mapped on little-endian hosts")
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:4] != b"RIFF" or self.map[8:12] != b"WAVE":
+            raise ValueError("not a WAV file")
+        position, fmt, data = 12, None, None
+        while position + 8 <= len(self.map):
+            chunk_id, size = self.map[position:position + 4], struct.unpack_from("<I", self.map, position + 4)[0]
+            if chunk_id == b"fmt ":
+                fmt = struct.unpack_from("<HHIIHH", self.map, position + 8)
+                if fmt[0] == 0xFFFE:
+                    # WAVE_FORMAT_EXTENSIBLE: the actual format tag starts the subformat GUID.
+                    fmt = (struct.unpack_from("<H", self.map, position + 32)[0],) + fmt[1:]
+            elif chunk_id == b"data":
+                # The size may be missing (e.g. from a recording that was cut short), so don't read past the file.
+                data = (position + 8, min(size, len(self.map) - position - 8))
+                break
+            position += 8 + size + size % 2
+        if fmt is None or data is None:
+            raise ValueError("WAV file is missing its format or data")
+        format_tag, self.channels, self.sample_rate, _, block_align, bits = fmt
+        self.frames = data[1] // block_align
+        start = data[0]
+        self.data = memoryview(self.map)[start:start + self.frames * block_align]
+        if packed and (format_tag, bits) == (1, 24):
+            self.samples, self.scale = None, 2**31  # once widened to 32 bits (see `read`)
+            return
+        if (format_tag, bits // 8) not in self.TYPECODES:
+            self.samples = None
+            self.close()
+            raise ValueError(f"unsupported WAV format ({format_tag}, {bits} bits)")
+        typecode, self.scale = self.TYPECODES[format_tag, bits // 8]
+        self.samples = self.data.cast(typecode)
+
+    def channel(self, index=0):
+        # Samples of one channel (as stored: integers need dividing by `scale`), as a strided view into the file.
+        return self.samples[index::self.channels]
+
+    def read(self, index=0, start=0, stop=None):
+        # Copy of frames [start, stop) of one channel, as floats in [-1, 1].
+        stop = self.frames if stop is None else min(stop, self.frames)
+        start = min(start, stop)
+        if self.samples is None:
+            # 24-bit samples become the top three bytes of 32-bit ones.
+            data = self.data[start * self.channels * 3:stop * self.channels * 3]
+            wide = bytearray(len(data) // 3 * 4)
+            for byte in range(3):
+                wide[byte + 1::4] = data[byte::3]
+            samples = memoryview(wide).cast("i")[index::self.channels]
+        else:
+            samples = self.channel(index)[start:stop]
+        if self.scale is None:
+            return array.array('f', samples)
+        return array.array('f', map((1 / self.scale).__mul__, samples))
+
+    def close(self):
+        # Release the mapping. Views of its samples must not be used afterwards.
+        if self.samples is not None:
+            self.samples.release()
+        self.data.release()
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def generate_wave(path, it, length=None, time_limit=None, sample_rate=SAMPLE_RATE, sample_format="int16"):
+    # Audio is written one block at a time, so the whole clip never has to be in memory.
+    # It goes into a temporary file that only replaces `path` once complete,
+    # so a render that fails, times out, or is cancelled never leaves a partial file behind.
+    # `time_limit` defaults to `TIME_LIMIT` (as it is when called); 0 means no limit.
+    # Returns the number of frames written.
+    tmp_path = path + ".part"
+    if time_limit is None:
+        time_limit = TIME_LIMIT
+    deadline = time.monotonic() + time_limit if time_limit else None
+    written = 0
+    try:
+        channels, frames = channel_blocks(it, MAX_LENGTH if length is None else length)
+        with WaveWriter(tmp_path, channels, sample_rate, sample_format) as wav:
+            for block in frames:
+                wav.write(convert_block(block, sample_format))
+                written += len(block) // channels
+                if deadline is not None and time.monotonic() > deadline:
+                    raise RenderLimitExceeded(f"render took longer than {time_limit} seconds")
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return written
+
+def peek(iterable, default=None):
+    it = iter(iterable)
+    try:
+        first = next(it)
+    except StopIteration:
+        return (default, ())
+    return (first, itertools.chain((first,), it))
+
+def split_output(output):
+    # Determine whether an expression's output is MIDI (note dicts) or audio (samples or buffers).
+    # Returns (is_midi, output); use the returned `output` afterwards, since peeking consumes from iterators.
+    if output is None:
+        return False, ()
+    if isinstance(output, NoteArray):
+        return True, output
+    if isinstance(output, tuple):
+        # Tuples are used for multichannel audio (see `channel_blocks`), so avoid turning them into iterators.
+        return bool(output) and isinstance(output[0], Mapping), output
+    if as_buffer(output) is not None or hasattr(output, "blocks"):
+        return False, output
+    first, output = peek(output)
+    # Notes may be dicts, or views of a NoteArray's notes (see notearray.py).
+    return isinstance(first, Mapping), output
+
+def convert_note(note):
+    # NOTE: We don't add back `take_start` here due to reapy inconsistency.
+    # "dur" is derived from start and end, so it's dropped (without modifying `note`, which may belong to an input).
+    return {key: value for key, value in note.items() if key != "dur"}
+
+def note_events(notes, to_ppq):
+    # MIDI events for notes (a NoteArray, or note dicts), with times converted to PPQ by `to_ppq`.
+    # Returns a sorted list of (PPQ, flags, message), as they appear in MIDI source chunks (see `midi_source`).
+    if isinstance(notes, NoteArray):
+        rows = zip(notes.start, notes.end, notes.channel, notes.pitch, notes.velocity, notes.selected, notes.muted)
+    else:
+        rows = ((note["start"], note["end"], note.get("channel", 0), note["pitch"], note.get("velocity", 100),
+                 note.get("selected"), note.get("muted")) for note in notes)
+    events = []
+    for start, end, channel, pitch, velocity, selected, muted in rows:
+        # Out-of-range values (e.g. from transposing too far) are clamped, as `MIDI_InsertNote` would.
+        channel, pitch, velocity = min(max(int(channel), 0), 15), min(max(int(pitch), 0), 127), min(max(int(velocity), 0), 127)
+        # Flags as in REAPER's state chunks: "e" for selected events, "m" for muted ones.
+        flags = ("e" if selected else "E") + ("m" if muted else "")
+        events.append((to_ppq(start), 1, flags, f"{0x90 | channel:02x} {pitch:02x} {velocity:02x}"))
+        events.append((to_ppq(end), 0, flags, f"{0x80 | channel:02x} {pitch:02x} 00"))
+    # Note-offs go before note-ons at the same position, so repeated notes don't cut each other off.
+    events.sort(key=lambda event: event[:2])
+    return [(ppq, flags, message) for ppq, _, flags, message in events]
+
+def midi_source(events, ticks, end):
+    # Lines of a MIDI source chunk holding `events` (see `note_events`), with `ticks` per quarter note, lasting until `end` (PPQ).
+    lines = ["<SOURCE MIDI", f"HASDATA 1 {ticks} QN"]
+    position = 0
+    for ppq, flags, message in events:
+        lines.append(f"{flags} {ppq - position} {message}")
+        position = ppq
+    lines += [f"E {max(end - position, 0)} b0 7b 00", ">"]
+    return lines
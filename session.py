@@ -1,5 +1,6 @@
 import ctypes
 import importlib
+import os
 import time
 import traceback
 
@@ -8,6 +9,10 @@ import reapy
 lambdaw = None
 project_info = None
 needs_load = True
+# Per-project lambdaw state (see `lambdaw.save_state`), so that switching between project tabs doesn't require a reload.
+project_states = {}
+# mtime of lambdaw.py when it was (re)imported; "reload" only re-imports lambdaw itself if it has changed.
+lambdaw_mtime = None
 reapy.delete_ext_state("lambdaw", "pending")
 
 # HACK: Crazy workaround for issue with REAPER's Python support.
@@ -15,39 +20,113 @@ reapy.delete_ext_state("lambdaw", "pending")
 # This affects *all* instances of Python and can screw up libraries that depend on ctypes
 # by causing spurious ctypes ArgumentErrors (due to mismatch between pre- and post-reset pointer types).
 # To workaround this, we restore *our* ctypes cache whenever we re-enter this script (and save it when we defer).
+# A marker entry tells us whether the cache has been reset since we last saw it, so that on most ticks
+# neither restoring nor saving needs to copy anything.
+class CacheMarker:
+    pass
+
+ctypes._pointer_type_cache[CacheMarker] = None
 ctype_backup = ctypes._pointer_type_cache.copy()
 
+def restore_ctypes_cache():
+    if CacheMarker not in ctypes._pointer_type_cache:
+        ctypes._pointer_type_cache.update(ctype_backup)
+
+def save_ctypes_cache():
+    if len(ctypes._pointer_type_cache) != len(ctype_backup):
+        ctype_backup.update(ctypes._pointer_type_cache)
+
+# Adaptive polling: poll on every tick while something is going on (playback, recording, renders in progress,
+# or recent edits), then back off gradually to IDLE_INTERVAL once things are quiet.
+# Setting the "pending" ext state (eval_all.py, eval_selected.py, reload.py) always wakes the loop up immediately.
+IDLE_INTERVAL = 0.5  # seconds
+ACTIVE_WINDOW = 2  # seconds to keep polling on every tick after the last activity
+interval = 0
+next_poll = 0
+last_activity = 0
+
+def schedule_next_poll(active):
+    global interval, next_poll, last_activity
+    now = time.monotonic()
+    # Play state: 1 = playing, 2 = paused, 4 = recording
+    if active or reapy.RPR.GetPlayState() & 5:
+        last_activity = now
+    if now - last_activity < ACTIVE_WINDOW:
+        interval = 0
+    else:
+        interval = min(IDLE_INTERVAL, max(interval * 2, 0.05))
+    next_poll = now + interval
+
+def report_load(message, timings):
+    phases = ", ".join(f"{phase} {seconds:.3f}" for phase, seconds in timings.items())
+    reapy.RPR.Help_Set(f"lambdaw: {message} in {sum(timings.values()):.3f} seconds ({phases})", False)
+
+def load_lambdaw():
+    # Returns the time taken by each phase of loading.
+    global lambdaw, lambdaw_mtime
+    start = time.perf_counter()
+    if lambdaw is None:
+        import lambdaw
+    elif os.stat(lambdaw.__file__).st_mtime_ns != lambdaw_mtime:
+        importlib.reload(lambdaw)
+        # States saved by the old code may not work with the new code.
+        project_states.clear()
+    else:
+        return lambdaw.load()
+    lambdaw_mtime = os.stat(lambdaw.__file__).st_mtime_ns
+    return {"import": time.perf_counter() - start - sum(lambdaw.load_timings.values()), **lambdaw.load_timings}
+
 def run_loop():
-    global lambdaw, project_info, needs_load, ctype_backup
-    ctypes._pointer_type_cache.update(ctype_backup)
+    global lambdaw, project_info, needs_load
+    restore_ctypes_cache()
 
     pending = reapy.get_ext_state("lambdaw", "pending")
+    if not pending and time.monotonic() < next_poll:
+        reapy.defer(run_loop)
+        return
+
+    active = bool(pending)
     current_project = reapy.Project()
     # Try to detect when user switches projects.
     # (ID only changes on tab switch, not when the user opens a different project in the current tab.)
     current_project_info = (current_project.id, current_project.name, current_project.path)
-    if project_info != current_project_info:
-        project_info = current_project_info
-        needs_load = True  # reload on project switch
-    elif pending == "reload" or (pending and not lambdaw):
-        needs_load = True
     try:
-        if needs_load:
-            start = time.time()
-            if lambdaw is None:
-                import lambdaw
+        if project_info != current_project_info:
+            if lambdaw and not needs_load:
+                project_states[project_info] = lambdaw.save_state()
+            project_info = current_project_info
+            state = project_states.get(project_info)
+            if lambdaw and state:
+                start = time.perf_counter()
+                lambdaw.restore_state(state)
+                report_load("switched project", {"restore": time.perf_counter() - start})
+                active = True
             else:
-                importlib.reload(lambdaw)
-            reapy.RPR.Help_Set(f"lambdaw: loaded module in {time.time() - start:.3f} seconds", False)
+                needs_load = True  # load on switch to a new project
+        elif (pending == "reload" and lambdaw and not needs_load and os.stat(lambdaw.__file__).st_mtime_ns == lambdaw_mtime
+              and not lambdaw.settings_changed()):
+            # Only re-execute project.py (if it changed), keeping everything else.
+            # Changed settings (worker mode, sample rate or format, time limit) need a full load.
+            start = time.perf_counter()
+            reloaded = lambdaw.load_project_module()
+            report_load("reloaded project module" if reloaded else "project module unchanged",
+                        {"project module": time.perf_counter() - start})
+            active = True
+        elif pending == "reload" or (pending and not lambdaw):
+            needs_load = True
+        if needs_load:
+            report_load("loaded module", load_lambdaw())
             needs_load = False
+            active = True
         if pending != "reload" and lambdaw:
-            lambdaw.execute(pending)
+            active |= lambdaw.execute(pending)
     except:
         reapy.show_message_box(traceback.format_exc(), "lambdaw exception")
 
     if pending:
         reapy.delete_ext_state("lambdaw", "pending")
-    ctype_backup.update(ctypes._pointer_type_cache)
+    schedule_next_poll(active)
+    save_ctypes_cache()
     reapy.defer(run_loop)
 
 run_loop()
@@ -0,0 +1,7 @@
+import reapy
+
+# Switch between evaluating expressions inside REAPER and in a separate worker process (see worker.py).
+enabled = reapy.get_ext_state("lambdaw", "worker") == "1"
+reapy.set_ext_state("lambdaw", "worker", "0" if enabled else "1", persist=True)
+reapy.set_ext_state("lambdaw", "pending", "reload")
+reapy.show_console_message(f"lambdaw: worker process {'disabled' if enabled else 'enabled'}\n")
@@ -0,0 +1,312 @@
+# Out-of-process expression evaluation.
+# Running expressions inside REAPER's embedded Python stalls the defer loop (and the UI),
+# and heavy imports such as torch or tensorflow deadlock it entirely.
+# Instead, lambdaw can start this script as a persistent worker process that keeps the project module loaded,
+# send it expressions over a local socket, and pick up the rendered results on later ticks.
+#
+# Protocol: lambdaw listens on a local port, and passes the worker the port (as an argument) and a random token (on stdin).
+# Before anything is unpickled, each side proves it knows the token (see `models.authenticate`), so other local processes
+# that connect to the port are turned away.
+# Then each message is a pickled tuple, prefixed by its length as a 4-byte big-endian integer.
+#   lambdaw -> worker: ("load", module_path, sample_rate)
+#                      ("eval", request_id, expression, bindings, target)
+#                      ("shutdown",)
+#   worker -> lambdaw: ("loaded", error_or_None)
+#                      ("result", request_id, result)
+#                      ("error", request_id, traceback)
+# where `result` is {"kind": "none"}, {"kind": "midi", "notes": [...]}, or {"kind": "audio", "path": ...},
+# along with timings and whether the output was a pattern ("positional").
+import importlib.util
+import os
+import pickle
+import secrets
+import socket
+import struct
+import subprocess
+import sys
+import time
+import traceback
+import types
+
+from notearray import NoteArray
+import cache
+import memo
+import models
+import patterns
+import profiling
+import render
+
+HEADER = struct.Struct("!I")
+STARTUP_TIMEOUT = 10  # seconds
+
+def send_message(sock, message):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+def recv_exactly(sock, size):
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            raise EOFError("connection closed")
+        buffer += chunk
+    return bytes(buffer)
+
+def recv_message(sock):
+    size, = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    return pickle.loads(recv_exactly(sock, size))
+
+
+# Client side (runs inside REAPER).
+
+def accept_worker(listener, token):
+    # Wait for the worker to connect, closing any other connections (which don't know the token) in the meantime.
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"lambdaw worker didn't connect within {STARTUP_TIMEOUT} seconds")
+        listener.settimeout(remaining)
+        sock, _ = listener.accept()
+        try:
+            models.authenticate(sock, token, b"server")
+        except (OSError, EOFError):
+            sock.close()
+            continue
+        return sock
+
+class Worker:
+    def __init__(self, lambdaw_dir, python="python"):
+        listener = socket.create_server(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+        token = secrets.token_bytes(32)
+        self.process = subprocess.Popen([python, os.path.abspath(__file__), lambdaw_dir, str(port)], cwd=lambdaw_dir,
+                                        stdin=subprocess.PIPE)
+        try:
+            self.process.stdin.write(token.hex().encode("ascii") + b"\n")
+            self.process.stdin.close()
+            self.sock = accept_worker(listener, token)
+        except:
+            self.process.kill()
+            raise
+        finally:
+            listener.close()
+        self.sock.setblocking(False)
+        self.buffer = bytearray()
+        self.next_id = 0
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def load(self, module_path, sample_rate):
+        self.send(("load", module_path, sample_rate))
+
+    def submit(self, expression, bindings, target):
+        request_id = self.next_id
+        self.next_id += 1
+        self.send(("eval", request_id, expression, bindings, target))
+        return request_id
+
+    def send(self, message):
+        self.sock.setblocking(True)
+        try:
+            send_message(self.sock, message)
+        finally:
+            self.sock.setblocking(False)
+
+    def poll(self):
+        # Return all messages that have arrived so far, without blocking.
+        while True:
+            try:
+                chunk = self.sock.recv(1 << 16)
+            except BlockingIOError:
+                break
+            if not chunk:
+                raise EOFError("lambdaw worker exited")
+            self.buffer += chunk
+        messages = []
+        while len(self.buffer) >= HEADER.size:
+            size, = HEADER.unpack_from(self.buffer)
+            if len(self.buffer) < HEADER.size + size:
+                break
+            messages.append(pickle.loads(self.buffer[HEADER.size:HEADER.size + size]))
+            del self.buffer[:HEADER.size + size]
+        return messages
+
+    def kill(self):
+        self.sock.close()
+        self.process.kill()
+        self.process.wait()
+
+    def close(self):
+        try:
+            self.send(("shutdown",))
+        except OSError:
+            pass
+        self.sock.close()
+        try:
+            self.process.wait(1)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+class Pool:
+    # Several workers, each with its own copy of the project module, so independent expressions can render in parallel.
+    def __init__(self, lambdaw_dir, size, python="python"):
+        self.lambdaw_dir = lambdaw_dir
+        self.python = python
+        self.module_path = None
+        self.sample_rate = render.SAMPLE_RATE
+        self.workers = [Worker(lambdaw_dir, python) for _ in range(size)]
+
+    def load(self, module_path, sample_rate=render.SAMPLE_RATE):
+        self.module_path, self.sample_rate = module_path, sample_rate
+        for worker in self.workers:
+            worker.load(module_path, sample_rate)
+
+    def restart(self, worker, kill=False):
+        # Replace a worker that died (or, with `kill`, one that is busy with an expression we no longer care about).
+        index = self.workers.index(worker)
+        if kill:
+            worker.kill()
+        else:
+            worker.close()
+        worker = self.workers[index] = Worker(self.lambdaw_dir, self.python)
+        if self.module_path is not None:
+            worker.load(self.module_path, self.sample_rate)
+        return worker
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+# Pools outlive reloads of lambdaw (which would otherwise orphan their processes), so keep track of them here.
+pools = {}
+
+def get_pool(lambdaw_dir, size, python="python"):
+    pool = pools.get(lambdaw_dir)
+    if pool is not None and (len(pool.workers) != size or pool.python != python):
+        pool.close()
+        pool = None
+    if pool is None:
+        pool = pools[lambdaw_dir] = Pool(lambdaw_dir, size, python)
+    else:
+        for worker in pool.workers:
+            if not worker.alive:
+                pool.restart(worker)
+    return pool
+
+def shutdown_workers():
+    for pool in pools.values():
+        pool.close()
+    pools.clear()
+
+# Server side (runs in the worker process).
+
+class Target:
+    # Stand-in for the REAPER take passed to output converters.
+    def __init__(self, path, length, sample_rate=render.SAMPLE_RATE, sample_format="int16", span=None, time_limit=None):
+        self.path = path
+        self.length = length  # frames
+        self.sample_rate = sample_rate
+        self.sample_format = sample_format
+        self.span = span  # (item position, item length, cycle length) in seconds, for patterns (see patterns.py)
+        self.time_limit = time_limit  # seconds (see `render.generate_wave`)
+        self.profile = False  # run under cProfile (see profiling.py)
+
+def convert_output(output, track_index, item_index, target):
+    if patterns.is_pattern(output):
+        output = patterns.to_notes(output, *target.span)
+    is_midi, output = render.split_output(output)
+    if is_midi:
+        notes = output if isinstance(output, NoteArray) else [render.convert_note(note) for note in output]
+        return {"kind": "midi", "notes": notes}
+    frames = render.generate_wave(target.path, output, target.length, time_limit=target.time_limit,
+                                  sample_rate=target.sample_rate, sample_format=target.sample_format)
+    return {"kind": "audio", "path": target.path, "frames": frames, "bytes": os.path.getsize(target.path)}
+
+def make_lambdaw_module():
+    # Project modules `import lambdaw` to register converters and reuse helpers.
+    # The real module only works inside REAPER, so give them a worker-side equivalent.
+    module = types.ModuleType("lambdaw")
+    module.SAMPLE_RATE = render.SAMPLE_RATE
+    module.generate_wave = render.generate_wave
+    module.peek = render.peek
+    module.convert_output = convert_output
+    module.output_converter = convert_output
+    def register_converters(input=None, output=None):
+        # Input conversion happens on the REAPER side, before values are sent over.
+        if output is not None:
+            module.output_converter = output
+    module.register_converters = register_converters
+    module.memoize = memo.memoize
+    module.model_server = models.model_server
+    return module
+
+def load_project(module_path, sample_rate):
+    lambdaw = sys.modules["lambdaw"] = make_lambdaw_module()
+    # The project's sample rate, for module-level code that reads `lambdaw.SAMPLE_RATE`.
+    lambdaw.SAMPLE_RATE = sample_rate
+    # Same memo directory and module version as lambdaw, so results are shared with it and other workers.
+    previous_version = memo.version
+    with open(module_path, "rb") as f:
+        memo.configure(os.path.abspath("memo"), cache.fingerprint(f.read()))
+    if previous_version != memo.version:
+        memo.invalidate(previous_version)
+    spec = importlib.util.spec_from_file_location("project", module_path)
+    user_project_module = importlib.util.module_from_spec(spec)
+    sys.modules["project"] = user_project_module
+    spec.loader.exec_module(user_project_module)
+    namespace = {"sr": sample_rate}
+    exec("from project import *", namespace)
+    return lambdaw, namespace
+
+def serve(port, token):
+    render.enable_numpy()
+    sock = socket.create_connection(("127.0.0.1", port))
+    models.authenticate(sock, token, b"client")
+    lambdaw, namespace = make_lambdaw_module(), {"sr": render.SAMPLE_RATE}
+    while True:
+        try:
+            message = recv_message(sock)
+        except EOFError:
+            break
+        if message[0] == "load":
+            try:
+                lambdaw, namespace = load_project(*message[1:])
+            except:
+                send_message(sock, ("loaded", traceback.format_exc()))
+            else:
+                send_message(sock, ("loaded", None))
+        elif message[0] == "eval":
+            _, request_id, expression, bindings, (track_index, item_index, target) = message
+            namespace.update(bindings)
+            lambdaw.SAMPLE_RATE = target.sample_rate
+            def evaluate():
+                start = time.perf_counter()
+                # Add parenthesis to shorten common case of generator expressions.
+                output = eval("(" + expression + ")", namespace)
+                eval_time = time.perf_counter() - start
+                start = time.perf_counter()
+                # Patterns depend on the item's position, not just the render key (see `lambdaw.index_take`).
+                positional = patterns.is_pattern(output)
+                result = lambdaw.output_converter(output, track_index, item_index, target)
+                # Timings for the profiler in lambdaw (see profiling.py).
+                return {**result, "positional": positional, "eval_time": eval_time, "convert_time": time.perf_counter() - start}
+            try:
+                if target.profile:
+                    result, report = profiling.profiled(evaluate)
+                    result["profile"] = report
+                else:
+                    result = evaluate()
+            except:
+                send_message(sock, ("error", request_id, traceback.format_exc()))
+            else:
+                send_message(sock, ("result", request_id, result))
+        elif message[0] == "shutdown":
+            break
+    sock.close()
+
+if __name__ == "__main__":
+    sys.path.insert(1, sys.argv[1])
+    serve(int(sys.argv[2]), bytes.fromhex(sys.stdin.readline()))